@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Dependencies:
+#  none (standard library only)
+
+"""
+Fake Fronius, Tasmota and Keenetic devices for benchmarking the exporters
+
+Each device answers the API endpoints queried by its exporter with latency,
+jitter, a failure rate and a payload size given on the command line. A
+number of devices of one kind are served on consecutive ports.
+
+  Fronius:  /solar_api/v1/GetPowerFlowRealtimeData.fcgi (size: inverters)
+  Tasmota:  /cm?cmnd=status+<n> (size: additional sensors)
+  Keenetic: auth (X-NDM challenge), rci/show/system, rci/show/interface,
+            rci/show/interface/stat, rci/show/ip/hotspot/summary and RCI
+            batch requests to rci/ (size: interfaces and hotspot clients)
+"""
+
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+PROGRAMNAME = os.path.basename(sys.argv[0])
+USERNAME = "admin"
+PASSWORD = "secret"
+REALM = "Keenetic Benchmark"
+
+class Device(BaseHTTPRequestHandler):
+  """ Fake device answering with configurable latency, jitter and failure rate """
+
+  protocol_version = "HTTP/1.1"
+  # Headers and body are written separately, avoid delayed ACKs on keep-alive connections
+  disable_nagle_algorithm = True
+  latency = 0
+  jitter = 0
+  failure_rate = 0
+  size = 1
+
+  # pylint: disable=invalid-name; Method provided by upstream class
+  def do_GET(self):
+    self.handle_request(None)
+
+  # pylint: disable=invalid-name; Method provided by upstream class
+  def do_POST(self):
+    length = int(self.headers.get('Content-Length', 0))
+    self.handle_request(json.loads(self.rfile.read(length)))
+
+  def handle_request(self, body):
+    """ Delay, fail or answer a request """
+    time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+    if random.random() < self.failure_rate:
+      self.send(500, {"error": "injected failure"})
+      return
+    url = urlsplit(self.path)
+    self.route(url.path, parse_qs(url.query), body)
+
+  def route(self, path, query, body): # pylint: disable=unused-argument
+    """ Answer the request of 'path', devices without such an endpoint answer 404 """
+    self.send(404)
+
+  def send(self, code, data=None, headers=None):
+    """ Send 'data' as JSON response """
+    content = json.dumps(data).encode('utf-8') if data is not None else b""
+    self.send_response(code)
+    for (key, value) in (headers or {}).items():
+      self.send_header(key, value)
+    self.send_header('Content-Type', "application/json")
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, *_):
+    pass
+
+class Fronius(Device):
+  """ Fronius Gen24 inverter (site controller) """
+
+  def route(self, path, query, body):
+    if path != "/solar_api/v1/GetPowerFlowRealtimeData.fcgi":
+      self.send(404)
+      return
+    pv = random.uniform(0, 8000)
+    load = -random.uniform(200, 3000)
+    inverters = {str(i): {"DT": 1, "E_Day": None, "E_Total": 1e7, "P": pv / self.size} for i in range(1, self.size + 1)}
+    self.send(200, {"Body": {"Data": {
+      "Inverters": inverters,
+      "Site": {"P_Akku": None, "P_Grid": -(pv + load), "P_Load": load, "P_PV": pv,
+               "rel_Autonomy": 100.0, "rel_SelfConsumption": 50.0, "Mode": "meter", "E_Day": None},
+    }}, "Head": {"Status": {"Code": 0}}})
+
+class Tasmota(Device):
+  """ Tasmota WiFi socket """
+
+  def route(self, path, query, body):
+    if path != "/cm":
+      self.send(404)
+      return
+    energy = {"TotalStartTime": "2024-01-01T00:00:00", "Total": 123.4, "Yesterday": 1.2, "Today": 0.4,
+              "Power": random.randint(0, 2000), "ApparentPower": 60, "ReactivePower": 12, "Factor": 0.9,
+              "Voltage": 230, "Current": 0.26}
+    sensors = {"Time": "2024-01-01T00:00:00", "ENERGY": energy}
+    for i in range(1, self.size):
+      sensors[f"DS18B20-{i}"] = {"Id": f"{i:012X}", "Temperature": 21.5}
+    sections = {
+      "Status": {"Module": 54, "DeviceName": "Benchmark", "FriendlyName": ["Benchmark"], "Power": 1},
+      "StatusFWR": {"Version": "13.2.0(tasmota)"},
+      "StatusNET": {"Hostname": "tasmota", "IPAddress": "127.0.0.1"},
+      "StatusSNS": sensors,
+      "StatusSTS": {"Time": "2024-01-01T00:00:00", "POWER": "ON", "Wifi": {"RSSI": 80, "Signal": -60}},
+    }
+    command = query.get('cmnd', [""])[0].split()
+    number = command[1] if len(command) > 1 else ""
+    if number == "0":
+      self.send(200, sections)
+    elif number in {"8", "10"}:
+      self.send(200, {"StatusSNS": sections["StatusSNS"]})
+    elif number == "11":
+      self.send(200, {"StatusSTS": sections["StatusSTS"]})
+    else:
+      self.send(200, {"Command": "Unknown"})
+
+class Keenetic(Device):
+  """ Keenetic router with challenge-response authentication """
+
+  challenge = uuid.uuid4().hex
+  sessions = set()
+  lock = threading.Lock()
+
+  def authenticated(self):
+    """ Return True if the request carries a valid session cookie """
+    cookies = dict(c.strip().split("=", 1) for c in self.headers.get('Cookie', "").split(";") if "=" in c)
+    with self.lock:
+      return cookies.get('session') in self.sessions
+
+  def route(self, path, query, body):
+    if path == "/auth":
+      self.auth(body)
+    elif not self.authenticated():
+      self.send(401, None, {'X-NDM-Realm': REALM, 'X-NDM-Challenge': self.challenge})
+    elif path == "/rci/" and isinstance(body, list):
+      self.send(200, [self.rci(c) for c in body])
+    elif path == "/rci/show/system":
+      self.send(200, self.system())
+    elif path == "/rci/show/interface":
+      self.send(200, self.interfaces())
+    elif path == "/rci/show/interface/stat":
+      name = query.get('name', [""])[0]
+      self.send(200, self.stat() if self.known(name) else {"status": [{"status": "error", "message": f"unable to find {name}"}]})
+    elif path == "/rci/show/ip/hotspot/summary":
+      self.send(200, self.hotspot(query.get('attribute', ["rxbytes"])[0]))
+    else:
+      self.send(404)
+
+  def auth(self, body):
+    """ X-NDM challenge-response authentication """
+    if body is None:
+      if self.authenticated():
+        self.send(200, {})
+      else:
+        self.send(401, None, {'X-NDM-Realm': REALM, 'X-NDM-Challenge': self.challenge})
+      return
+    md5 = hashlib.md5(f"{USERNAME}:{REALM}:{PASSWORD}".encode('utf-8')).hexdigest()
+    expected = hashlib.sha256((self.challenge + md5).encode('utf-8')).hexdigest()
+    if body.get('login') != USERNAME or body.get('password') != expected:
+      self.send(401, None, {'X-NDM-Realm': REALM, 'X-NDM-Challenge': self.challenge})
+      return
+    session = uuid.uuid4().hex
+    with self.lock:
+      self.sessions.add(session)
+    self.send(200, {}, {'Set-Cookie': f"session={session}; Path=/"})
+
+  def rci(self, command):
+    """ Answer a single command of an RCI batch request """
+    try:
+      name = command["show"]["interface"]["stat"]["name"]
+    except (KeyError, TypeError):
+      return {"status": [{"status": "error", "message": "unsupported command"}]}
+    if not self.known(name):
+      return {"status": [{"status": "error", "message": f"unable to find {name}"}]}
+    return {"show": {"interface": {"stat": self.stat()}}}
+
+  def known(self, name):
+    """ Return True if interface 'name' exists """
+    return any(interface["interface-name"] == name for interface in self.interfaces().values())
+
+  def system(self):
+    return {"hostname": "Keenetic", "domainname": "WORKGROUP", "cpuload": random.randint(0, 100),
+            "memory": "1/2", "memtotal": 262144, "memfree": 131072, "membuffers": 1024, "memcache": 2048,
+            "swaptotal": 0, "swapfree": 0, "uptime": int(time.monotonic())}
+
+  def interfaces(self):
+    return {f"GigabitEthernet{i}": {"id": f"GigabitEthernet{i}", "index": i, "interface-name": f"eth{i}",
+                                    "type": "GigabitEthernet", "description": f"Port {i}", "link": "up",
+                                    "state": "up", "mtu": 1500} for i in range(self.size)}
+
+  def stat(self):
+    return {"rxpackets": random.randint(0, 1 << 32), "rx-multicast-packets": 10, "rx-broadcast-packets": 20,
+            "rxbytes": random.randint(0, 1 << 40), "rxerrors": 0, "rxdropped": 0, "txpackets": 1000,
+            "tx-multicast-packets": 10, "tx-broadcast-packets": 20, "txbytes": random.randint(0, 1 << 40),
+            "txerrors": 0, "txdropped": 0, "timestamp": time.time(), "last-overflow": 0}
+
+  def hotspot(self, attribute):
+    return {"host": [{"mac": f"02:00:00:00:{i >> 8:02x}:{i & 255:02x}", "ip": f"192.168.{1 + (i >> 8)}.{i & 255}",
+                      "hostname": f"client-{i}", "name": f"Client {i}", attribute: random.randint(0, 1 << 30)}
+                     for i in range(self.size)]}
+
+DEVICES = {'fronius': Fronius, 'tasmota': Tasmota, 'keenetic': Keenetic}
+
+def serve(kind, address, port, count, **settings):
+  """ Start 'count' devices of 'kind' on consecutive ports in background threads, returns the servers """
+  handler = type(DEVICES[kind].__name__, (DEVICES[kind],), settings)
+  servers = []
+  for i in range(count):
+    server = ThreadingHTTPServer((address, port + i), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=f"{kind}-{port + i}", daemon=True).start()
+    servers.append(server)
+  return servers
+
+if __name__ == '__main__':
+  def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=60)
+  cli = argparse.ArgumentParser(
+    prog = PROGRAMNAME,
+    description = "Fake Fronius, Tasmota and Keenetic devices for benchmarking the exporters.",
+    epilog = "",
+    formatter_class=formatter
+  )
+  cli.add_argument('kind', choices=DEVICES, help="kind of device")
+  cli.add_argument('-a', '--address', action='store', default="127.0.0.1", help="listen address")
+  cli.add_argument('-p', '--port', action='store', type=int, default=7000, help="port of the first device")
+  cli.add_argument('-n', '--count', action='store', type=int, default=1, help="number of devices")
+  cli.add_argument('--latency', action='store', type=float, default=0, help="response latency in seconds")
+  cli.add_argument('--jitter', action='store', type=float, default=0, help="random deviation from the latency")
+  cli.add_argument('--failure-rate', action='store', type=float, default=0, help="share of failed requests")
+  cli.add_argument('--size', action='store', type=int, default=1, help="payload size (inverters, sensors, interfaces)")
+  args = cli.parse_args()
+
+  serve(args.kind, args.address, args.port, args.count,
+    latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, size=args.size)
+  print(f"Serving {args.count} {args.kind} device(s) on {args.address}:{args.port}+ ...", flush=True)
+  try:
+    threading.Event().wait()
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Dependencies:
+#  apt install python3-yaml
+#  the dependencies of the exporter under test
+
+"""
+Load benchmark of the Fronius, Tasmota and Keenetic exporters
+
+Starts fake devices (see devices.py) and the exporter under test with a
+generated config, then scrapes it at increasing concurrency. Reports p50/p99
+scrape latency, scrapes/s, errors and the exporter's CPU usage and RSS per
+concurrency level. Results can be saved as JSON and compared against a
+baseline of an earlier version to catch regressions.
+
+  benchmark/run.py tasmota --devices 20 --latency 0.05 --jitter 0.02 --json new.json --baseline old.json
+"""
+
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import argparse
+import yaml
+from yaml.loader import SafeLoader
+
+import devices
+
+PROGRAMNAME = os.path.basename(sys.argv[0])
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+class Exporter():
+  """ Exporter script, its default config and the modules probed """
+
+  def __init__(self, script, conf, modules):
+    self.script = script
+    self.conf = conf
+    self.modules = modules
+
+# Exporters per kind of device
+EXPORTERS = {
+  'fronius': Exporter("fronius-exporter/fronius-exporter.py", "fronius-exporter/fronius-exporter.conf",
+                      ["GetPowerFlowRealtimeData"]),
+  'tasmota': Exporter("tasmota-exporter/tasmota-exporter.py", "tasmota-exporter/tasmota-exporter.conf", ["StatusSNS"]),
+  'keenetic': Exporter("keenetic-api-exporter/prometheus-keenetic-api-exporter.py",
+                       "keenetic-api-exporter/prometheus-keenetic-api-exporter.conf", ["system", "interface"]),
+}
+
+def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=60)
+cli = argparse.ArgumentParser(
+  prog = PROGRAMNAME,
+  description = "Load benchmark of the exporters against fake devices.",
+  epilog = "",
+  formatter_class=formatter
+)
+cli.add_argument('kind', choices=EXPORTERS, help="exporter to benchmark")
+cli.add_argument('-n', '--devices', action='store', type=int, default=10, help="number of fake devices (targets)")
+cli.add_argument('--latency', action='store', type=float, default=0.02, help="device response latency in seconds")
+cli.add_argument('--jitter', action='store', type=float, default=0.01, help="random deviation from the latency")
+cli.add_argument('--failure-rate', action='store', type=float, default=0, help="share of failed device requests")
+cli.add_argument('--size', action='store', type=int, default=4, help="payload size (inverters, sensors, interfaces)")
+cli.add_argument('-c', '--concurrency', action='store', default="1,2,4,8,16,32", help="concurrent scrapers per step")
+cli.add_argument('-d', '--duration', action='store', type=float, default=10, help="seconds per step")
+cli.add_argument('-w', '--workers', action='store', type=int, default=16, help="exporter worker threads")
+cli.add_argument('--cache', action=argparse.BooleanOptionalAction, help="keep the exporter's scrape cache enabled")
+cli.add_argument('--exporter-args', action='store', default="", help="additional exporter arguments, e.g. '--poll'")
+cli.add_argument('--device-port', action='store', type=int, default=17000, help="port of the first fake device")
+cli.add_argument('--port', action='store', type=int, default=18000, help="exporter port")
+cli.add_argument('--json', action='store', help="save results to this file")
+cli.add_argument('--baseline', action='store', help="compare against results saved earlier")
+cli.add_argument('--threshold', action='store', type=float, default=10, help="tolerated regression in percent")
+
+def config(kind, targets, cache):
+  """ Return the exporter config: the shipped default with the fake devices as targets """
+  with open(os.path.join(ROOT, EXPORTERS[kind].conf), encoding="utf-8") as f:
+    result = yaml.load(f, Loader=SafeLoader)
+  if kind == 'fronius':
+    result['targets'] = {target: None for target in targets}
+  elif kind == 'tasmota':
+    result['targets'] = {target: {'username': "admin", 'password': "secret"} for target in targets}
+    result.pop('mqtt', None)
+  else:
+    result['auth'] = {target: {'username': devices.USERNAME, 'password': devices.PASSWORD} for target in targets}
+  if not cache:
+    result['cache'] = {'ttl': 0, 'stale': 0}
+  return result
+
+def cpu(pid):
+  """ Return the CPU seconds used by process 'pid' """
+  with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+    fields = f.read().rsplit(")", 1)[1].split()
+  return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def rss(pid):
+  """ Return the resident set size of process 'pid' in MB """
+  with open(f"/proc/{pid}/statm", encoding="utf-8") as f:
+    return int(f.read().split()[1]) * PAGE_SIZE / 1024 / 1024
+
+def percentile(values, p):
+  """ Nearest-rank percentile 'p' of sorted 'values' """
+  if not values:
+    return 0
+  return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+class Tally():
+  """ Latencies and errors of all scrapers of a step """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = []
+    self.errors = 0
+
+  def add(self, latencies, errors):
+    """ Add the results of a single scraper """
+    with self.lock:
+      self.latencies.extend(latencies)
+      self.errors += errors
+
+def scraper(port, paths, until, tally):
+  """ Scrape 'paths' round-robin on a keep-alive connection until 'until' """
+  connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+  own, failed, i = [], 0, 0
+  while time.monotonic() < until:
+    start = time.perf_counter()
+    try:
+      connection.request("GET", paths[i % len(paths)])
+      response = connection.getresponse()
+      response.read()
+      if response.status != 200:
+        failed += 1
+    except (OSError, http.client.HTTPException):
+      failed += 1
+      connection.close()
+      connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    own.append(time.perf_counter() - start)
+    i += 1
+  connection.close()
+  tally.add(own, failed)
+
+def step(pid, port, paths, concurrency, duration):
+  """ Run one benchmark step at 'concurrency', returns its result dict """
+  tally = Tally()
+  cpu_start, wall_start = cpu(pid), time.monotonic()
+  until = wall_start + duration
+  threads = [threading.Thread(target=scraper, args=(port, paths[i::concurrency] or paths, until, tally))
+             for i in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall = time.monotonic() - wall_start
+
+  latencies = sorted(tally.latencies)
+  return {
+    'concurrency': concurrency,
+    'scrapes': len(latencies),
+    'rate': len(latencies) / wall,
+    'p50': percentile(latencies, 50) * 1000,
+    'p99': percentile(latencies, 99) * 1000,
+    'errors': tally.errors,
+    'cpu': (cpu(pid) - cpu_start) / wall * 100,
+    'rss': rss(pid),
+  }
+
+def ready(port, timeout=30):
+  """ Wait for the exporter to answer on /metrics """
+  until = time.monotonic() + timeout
+  while time.monotonic() < until:
+    try:
+      connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+      connection.request("GET", "/metrics")
+      if connection.getresponse().status == 200:
+        return
+    except OSError:
+      time.sleep(0.2)
+  raise TimeoutError(f"Exporter not ready on port {port} within {timeout}s")
+
+def compare(results, baseline, threshold):
+  """ Print regressions of 'results' against 'baseline', returns True if there are any """
+  previous = {r['concurrency']: r for r in baseline['results']}
+  regressed = False
+  for result in results:
+    old = previous.get(result['concurrency'])
+    if old is None:
+      continue
+    for (key, worse) in (('rate', lambda new, old: new < old), ('p99', lambda new, old: new > old)):
+      change = (result[key] - old[key]) / old[key] * 100 if old[key] else 0
+      if worse(result[key], old[key]) and abs(change) > threshold:
+        regressed = True
+        print(f"REGRESSION concurrency {result['concurrency']}: {key} {old[key]:.1f} -> {result[key]:.1f} ({change:+.1f}%)")
+  return regressed
+
+def main():
+  args = cli.parse_args()
+  exporter = EXPORTERS[args.kind]
+  targets = [f"127.0.0.1:{args.device_port + i}" for i in range(args.devices)]
+  devices.serve(args.kind, "127.0.0.1", args.device_port, args.devices,
+    latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, size=args.size)
+
+  with tempfile.NamedTemporaryFile("w", suffix=".conf", delete=False) as f:
+    yaml.safe_dump(config(args.kind, targets, args.cache), f)
+  command = [sys.executable, os.path.join(ROOT, exporter.script), "-c", f.name, "-l", f"127.0.0.1:{args.port}",
+             "--workers", str(args.workers), *args.exporter_args.split()]
+  with subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as process:
+    try:
+      ready(args.port)
+      query = "".join(f"&module={module}" for module in exporter.modules)
+      paths = [f"/?target={target}{query}" for target in targets]
+      # Warm up sessions, caches and compiled families
+      step(process.pid, args.port, paths, 1, 1)
+
+      results = []
+      print(f"{args.kind}: {args.devices} devices, latency {args.latency}s ± {args.jitter}s, "
+            f"failure rate {args.failure_rate}, size {args.size}")
+      print(f"{'conc':>5} {'scrapes/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7} {'cpu %':>7} {'rss MB':>7}")
+      for concurrency in (int(c) for c in args.concurrency.split(",")):
+        r = step(process.pid, args.port, paths, concurrency, args.duration)
+        results.append(r)
+        print(f"{r['concurrency']:>5} {r['rate']:>10.1f} {r['p50']:>9.1f} {r['p99']:>9.1f} {r['errors']:>7} "
+              f"{r['cpu']:>7.1f} {r['rss']:>7.1f}", flush=True)
+    finally:
+      # Leaving the with block waits for the exporter
+      process.terminate()
+      os.unlink(f.name)
+
+  if args.json:
+    with open(args.json, "w", encoding="utf-8") as out:
+      json.dump({'kind': args.kind, 'settings': vars(args), 'results': results}, out, indent=2)
+  if args.baseline:
+    with open(args.baseline, encoding="utf-8") as baseline:
+      if compare(results, json.load(baseline), args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Dependencies:
+#  apt install python3-prometheus-client
+#  apt install python3-yaml
+#  prometheus_tools (shared exporter core, found next to this script's directory)
+#  the dependencies of the enabled exporters
+
+"""
+Prometheus multi-exporter host running the Fronius, Tasmota, Keenetic and
+public IP exporters as plugins in a single process
+"""
+
+import os
+import sys
+
+import argparse
+from argparse import BooleanOptionalAction
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+# pylint: disable=wrong-import-position
+from prometheus_tools import host, server, settings
+
+PROGRAMNAME = os.path.basename(sys.argv[0])
+CONFIGFILE = os.path.splitext(PROGRAMNAME)[0] + '.conf'
+LISTEN = ':8000'
+
+def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=45)
+cli = argparse.ArgumentParser(
+  prog = PROGRAMNAME,
+  description = __doc__,
+  epilog = "",
+  formatter_class=formatter
+)
+cli.add_argument('-c', '--config', action='store', default=CONFIGFILE, help="config file location")
+cli.add_argument('-l', '--listen', action='store', default=LISTEN, help="server address and port")
+cli.add_argument('--self-metrics', action=BooleanOptionalAction, help="enable process metrics")
+cli.add_argument('-w', '--workers', action='store', type=int, default=server.WORKERS, help="concurrent scrapes")
+
+if __name__ == '__main__':
+  args = cli.parse_args()
+  server.self_metrics(args.self_metrics)
+  handler = host.setup(settings.load(args.config))
+  print(f"Starting {PROGRAMNAME} with {', '.join(handler.plugins)} on {args.listen} ...")
+  server.serve(args.listen, handler, args.workers)
@@ -3,8 +3,8 @@
 # Dependencies:
 #  apt install python3-prometheus-client
 #  apt install python3-requests
-#  apt install python3-uritools
 #  apt install python3-yaml
+#  prometheus_tools (shared exporter core, found next to this script's directory)
 
 """
 Prometheus exporter for metrics of Fronius Gen24 inverters using
@@ -13,25 +13,21 @@ the open Fronius API interface
 
 import os
 import sys
-import traceback
 import logging
 import logging.handlers
-import json
 
 import argparse
 from argparse import BooleanOptionalAction
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from icecream import ic
-import prometheus_client as prom
-from prometheus_client import Metric, CollectorRegistry, generate_latest
-import requests
-from uritools import urisplit
-import yaml
-from yaml.loader import SafeLoader
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+# pylint: disable=wrong-import-position
+from prometheus_tools import breaker, cache, exposition, fanout, instrument, poller, recorder, server, settings, transport
 
 PROGRAMNAME = os.path.basename(sys.argv[0])
 CONFIGFILE = os.path.splitext(PROGRAMNAME)[0] + '.conf'
 LISTEN = ':8000'
+DEADLINE = 10
 
 def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=45)
 cli = argparse.ArgumentParser(
@@ -43,195 +39,147 @@ cli = argparse.ArgumentParser(
 cli.add_argument('-c', '--config', action='store', default=CONFIGFILE, help="config file location")
 cli.add_argument('-l', '--listen', action='store', default=LISTEN, help="server address and port")
 cli.add_argument('--self-metrics', action=BooleanOptionalAction, help="enable process metrics")
-args = cli.parse_args()
+cli.add_argument('-w', '--workers', action='store', type=int, default=server.WORKERS, help="concurrent scrapes")
+cli.add_argument('--poll', action=BooleanOptionalAction, help="poll devices in the background")
+cli.add_argument('--record', action='store', metavar='FILE', help="record device API responses to an archive")
+cli.add_argument('--replay', action='store', metavar='FILE', help="serve device API responses from an archive")
+cli.add_argument('--replay-speed', action='store', type=float, default=1, help="replay speed factor, 0 without delays")
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 loghandler = logging.handlers.SysLogHandler(address = '/dev/log')
 log.addHandler(loghandler)
 
-if not args.self_metrics:
-  prom.REGISTRY.unregister(prom.PROCESS_COLLECTOR)
-  prom.REGISTRY.unregister(prom.PLATFORM_COLLECTOR)
-  prom.REGISTRY.unregister(prom.GC_COLLECTOR)
-
 class Inverter():
 
   def __init__(self, config):
     self.config = config
+    self.pool = fanout.executor(name="fronius")
+    self.breakers = breaker.Breakers(getattr(config, 'breaker', None))
+    self.recorder = recorder.Recorder()
+
+    # Metric families are compiled once from the config
+    self.families = {}
+    for metric in config.modules['GetPowerFlowRealtimeData']['metrics']:
+      self.families[metric] = exposition.family(metric, f"Fronius inverter site metric {metric}")
+    for metric in ("P_fromGrid", "P_toGrid", "P_Usage"):
+      self.families[metric] = exposition.family(metric, f"Calculated site metric {metric}")
+    self.families["system_up"] = exposition.family("system_up",
+      "Fronius system answered within the scrape deadline", "gauge")
+    self.families["P_PV_0"] = exposition.family("P_PV_0", "Fronius site controller power output")
 
-  def request(self, ip, endpoint):
+  def request(self, ip, endpoint, timeout=DEADLINE):
     url = 'http://' + ip + endpoint
-    return requests.get(url, timeout=10)
-
-  def register(self, metrics, self_metrics=False):
-    """ Register a new Prometheus client registry """
-    class Collector():
-      """ Prometheus Client Collector class """
-      def collect(self):
-        """ Prometheus Client collect() function """
-        return metrics.values()
-
-    registry = CollectorRegistry()
-    registry.register(Collector())
+    send = partial(instrument.request, endpoint, transport.get, url, timeout=timeout)
+    return self.recorder.request(ip, endpoint, send)
 
-    if self_metrics:
-      registry.register(prom.PROCESS_COLLECTOR)
-      registry.register(prom.PLATFORM_COLLECTOR)
-      registry.register(prom.GC_COLLECTOR)
-
-    return registry
+  def site(self, ip, timeout):
+    """ Query the site power flow data of a single inverter """
+    endpoint = "/solar_api/v1/GetPowerFlowRealtimeData.fcgi"
+    r = self.request(ip, endpoint, timeout)
+    r = instrument.decode(endpoint, r.content)['Body']['Data']['Site']
+    return {k: v or 0 for (k, v) in r.items()}
 
   def GetPowerFlowRealtimeData(self, target):
     """
-      Returning grid metrics for each inverter on site
+      Returning the exposition of grid metrics for each inverter on site
       Multiple inverters are not supported by the Fronius API
       Combining results across multiple inverters has to be done in Grafana
+      Site controller and subsystems are queried concurrently within one deadline
       API endpoint: /solar_api/v1/GetPowerFlowRealtimeData.fcgi
     """
-    metrics = {}
-    labels = {}
-
-    result = b""
-    r = self.request(target, "/solar_api/v1/GetPowerFlowRealtimeData.fcgi")
-    r = json.loads(r.text)['Body']['Data']['Site']
-    r = {k: v or 0 for (k, v) in r.items()}
-    metric = "P_PV_0"
-    labels["system"] = "controller"
-    metrics[metric] = Metric(metric, "Fronius site controller power output", "untyped")
-    metrics[metric].add_sample(metric, value=r["P_PV"], labels={'system': 'controller'})
-
-    if self.config.targets[target]:
-      subsystems = self.config.targets[target]
-      i = 0
-      for s in subsystems:
-        i = i + 1
-        try:
-          sub_r = self.request(s, "/solar_api/v1/GetPowerFlowRealtimeData.fcgi")
-          sub_r = json.loads(sub_r.text)['Body']['Data']['Site']
-          sub_r = {k: v or 0 for (k, v) in sub_r.items()}
-          metric = f"P_PV_{i}"
-          metrics[metric] = Metric(metric, f"Fronius subsytem {i} power output", "untyped")
-          metrics[metric].add_sample(metric, value=sub_r["P_PV"], labels={'system': f'subsystem-{i}'})
-          r["P_PV"] += sub_r["P_PV"]
-        except requests.exceptions.RequestException as e:
-          ic.configureOutput(prefix="EXCEPTION| ")
-          ic(e)
-          print(f"Subsystem {s} is offline ...")
-          ic.configureOutput(prefix="")
-          labels["error"] = "requestError"
-
-    for metric in self.config.modules['GetPowerFlowRealtimeData']['metrics']:
-      metrics[metric] = Metric(metric, f"Fronius inverter site metric {metric}", "untyped")
-      if not r[metric]: r[metric] = 0
-      metrics[metric].add_sample(metric, value=r[metric], labels="")
-
-    for metric in ("P_fromGrid", "P_toGrid", "P_Usage"):
-      metrics[metric] = Metric(metric, f"Calculated site metric {metric}", "untyped")
-    if r["P_Grid"] < 0:
-      metrics["P_fromGrid"].add_sample("P_fromGrid", value=0, labels="")
-      metrics["P_toGrid"].add_sample("P_toGrid", value=r["P_Grid"] * -1, labels="")
-      metrics["P_Usage"].add_sample("P_Usage", value=r["P_PV"] + r["P_Grid"], labels="")
-    else:
-      metrics["P_fromGrid"].add_sample("P_fromGrid", value=r["P_Grid"], labels="")
-      metrics["P_toGrid"].add_sample("P_toGrid", value=0, labels="")
-      metrics["P_Usage"].add_sample("P_Usage", value=r["P_PV"] + r["P_Grid"], labels="")
-
-    registry = self.register(metrics)
-    result = generate_latest(registry)
-
-    return result
-
-class Config():
+    out = exposition.Exposition()
+
+    deadline = self.config.modules['GetPowerFlowRealtimeData'].get('deadline', DEADLINE)
+    systems = {"controller": target}
+    for (i, s) in enumerate(self.config.targets[target] or [], start=1):
+      systems[f"subsystem-{i}"] = s
+
+    # Offline systems (e.g. inverters sleeping at night) are skipped by their circuit breaker
+    calls = {system: partial(self.breakers[ip].call, self.site, ip, deadline) for (system, ip) in systems.items()}
+    sites, failures = fanout.gather(self.pool, calls, deadline)
+
+    for (system, e) in failures.items():
+      if isinstance(e, breaker.CircuitOpen):
+        continue
+      log.warning("System %s (%s) is offline: %r", systems[system], system, e)
+
+    for (system, ip) in systems.items():
+      out.add(self.families["system_up"], int(system in sites), {'system': system, 'address': ip})
+    self.breakers.expose(out, systems.values())
+
+    pv = 0
+    for (i, system) in enumerate(systems):
+      if system not in sites:
+        continue
+      family = exposition.family(f"P_PV_{i}", f"Fronius subsytem {i} power output") if i else self.families["P_PV_0"]
+      out.add(family, sites[system]["P_PV"], {'system': system})
+      pv += sites[system]["P_PV"]
+
+    # Site metrics are only available from the site controller
+    if "controller" in sites:
+      r = sites["controller"]
+      r["P_PV"] = pv
+
+      for metric in self.config.modules['GetPowerFlowRealtimeData']['metrics']:
+        out.add(self.families[metric], r[metric] or 0)
+
+      if r["P_Grid"] < 0:
+        out.add(self.families["P_fromGrid"], 0)
+        out.add(self.families["P_toGrid"], r["P_Grid"] * -1)
+      else:
+        out.add(self.families["P_fromGrid"], r["P_Grid"])
+        out.add(self.families["P_toGrid"], 0)
+      out.add(self.families["P_Usage"], r["P_PV"] + r["P_Grid"])
 
-  def __init__(self, configfile):
-    config = {}
+    return out
 
-    try:
-      f = open(configfile, encoding="utf-8")
-    except OSError:
-      print("Could not open/read file: " + configfile)
-      traceback.format_exc().strip()
-      sys.exit()
+class Handler(server.ExporterHandler):
+  """ HTTP server request handler class """
 
-    with f:
-      config = yaml.load(f, Loader=SafeLoader)
-      self._config = config
+  config = None
+  inverter = None
+  results = None
+  poller = None
+  scrapers = {'GetPowerFlowRealtimeData': 'GetPowerFlowRealtimeData'}
 
+  @classmethod
+  def scraper(cls, target, module):
+    """ Return the function scraping 'module' of 'target' """
+    if module not in cls.scrapers:
+      raise server.HTTPError(404, message="No such module!", explain=f"Cannot find module {module}.")
 
-  def __getattr__(self, key):
-    try:
-      return self._config[key]
-    except KeyError as e:
-      raise AttributeError(key) from e
+    return partial(getattr(cls.inverter, cls.scrapers[module]), target)
 
-class Handler(BaseHTTPRequestHandler):
-  """ HTTP server request handler class """
+  def collect(self, target, modules):
+    """ Provide data in Prometheus Exposition Format for all requested modules """
+    if self.poller:
+      return self.poller.collect(target, modules)
 
-  config = Config(args.config)
-  inverter = Inverter(config)
-
-  # pylint: disable=invalid-name; Method provided by upstream class
-  def do_GET(self):
-    """ Provide data in Prometheus Exposition Format upon client request """
-    url = urisplit(self.path)
-
-    self.error_message_format = """
-      <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
-        "http://www.w3.org/TR/html4/strict.dtd">
-      <html>
-        <head>
-          <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
-          <title>Error response</title>
-        </head>
-        <body>
-          <h1>Error response</h1>
-          <p>Error code: %(code)d</p>
-          <p>Traceback: <pre>%(message)s</pre></p>
-          <p>Error code explanation: %(code)s - %(explain)s.</p>
-        </body>
-      </html>
-    """
-
-    # Avoid errors from browsers auto-requesting favicons
-    if self.path == '/favicon.ico':
-      self.send_response(200)
-      self.send_header('Content-Type', 'image/x-icon')
-      self.send_header('Content-Length', 0)
-      self.end_headers()
-      return
-
-    query_params = url.getquerydict()
-    if "target" in query_params:
-      target = url.getquerydict().get('target')[0]
-    else:
-      self.send_error(404, message="No target!", explain="No target specified in query ...")
-      return
-
-    if target not in self.config.targets:
-      self.send_error(404, message="Target does not exist!", explain=f"Target {target} not configured ...")
-      return
-
-    # Prometheus is quering multiple modules in one request -> multiple 'module' params possible
-    modules = url.getquerydict().get('module')
-    if modules is None:
-      self.send_error(404, message="No module!", explain="No target specified in query ...")
-      return
-
-    metrics = b""
+    # Families shared by several modules are rendered below a single header
+    out = exposition.Exposition()
     for module in modules:
-      if module == "GetPowerFlowRealtimeData":
-        metrics = b"".join([metrics, self.inverter.GetPowerFlowRealtimeData(target)])
-      else:
-        trace = traceback.format_exc().strip()
-        self.send_error(404, message=trace, explain=f"Cannot find module {module}.")
-
-    self.send_response(200)
-    self.end_headers()
-    self.wfile.write(metrics)
+      out.merge(self.results.get(target, module, self.scraper(target, module)))
+
+    self.results.expose(out, target)
+    return out.render()
+
+def plugin(options, config):
+  """ Set up the exporter with 'config' and the command line 'options', returns its handler """
+  Handler.config = config
+  Handler.inverter = Inverter(config)
+  Handler.targets = config.targets
+  Handler.results = cache.Cache(getattr(config, 'cache', None))
+  Handler.inverter.recorder = recorder.Recorder(options.record, options.replay, options.replay_speed)
+  if options.poll:
+    jobs = poller.jobs(Handler.targets, config.modules, Handler.scraper)
+    Handler.poller = poller.Poller(jobs, getattr(config, 'poll', None))
+    Handler.poller.start()
+  return Handler
 
 if __name__ == '__main__':
-  address, port = args.listen.split(":")
-  print(f"Starting {PROGRAMNAME} on {address}:{port} ...")
-  server = HTTPServer((address, int(port)), Handler)
-  server.serve_forever()
+  args = cli.parse_args()
+  server.self_metrics(args.self_metrics)
+  handler = plugin(args, settings.load(args.config))
+  print(f"Starting {PROGRAMNAME} on {args.listen} ...")
+  server.serve(args.listen, handler, args.workers)
@@ -3,8 +3,8 @@
 # Dependencies:
 #  apt install python3-prometheus-client
 #  apt install python3-requests
-#  apt install python3-uritools
 #  apt install python3-yaml
+#  prometheus_tools (shared exporter core, found next to this script's directory)
 
 # Config file format:
 
@@ -22,24 +22,27 @@ Prometheus exporter for metrics of Keenetic home routers based on the Keenetic A
 
 import os
 import sys
-import traceback
+import threading
+import time
 
 import argparse
 from argparse import BooleanOptionalAction
+from functools import partial
 import hashlib
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import logging
 import logging.handlers
-import prometheus_client as prom
-from prometheus_client import Metric, CollectorRegistry, generate_latest
 import requests
-from uritools import urisplit
-import yaml
-from yaml.loader import SafeLoader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+# pylint: disable=wrong-import-position
+from prometheus_tools import cache, exposition, fanout, instrument, poller, recorder, server, settings, transport
 
 PROGRAMNAME = os.path.basename(sys.argv[0])
 CONFIGFILE = os.path.splitext(PROGRAMNAME)[0] + '.conf'
 LISTEN = ':8000'
+LIFETIME = 600
+TIMEOUT = 10
+INVENTORY_TTL = 300
 
 def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=60)
 cli = argparse.ArgumentParser(
@@ -51,139 +54,326 @@ cli = argparse.ArgumentParser(
 cli.add_argument('-c', '--config', action='store', default=CONFIGFILE, help="config file location")
 cli.add_argument('-l', '--listen', action='store', default=LISTEN, help="server address and port")
 cli.add_argument('--self-metrics', action=BooleanOptionalAction, help="enable process metrics")
-args = cli.parse_args()
+cli.add_argument('-w', '--workers', action='store', type=int, default=server.WORKERS, help="concurrent scrapes")
+cli.add_argument('--poll', action=BooleanOptionalAction, help="poll devices in the background")
+cli.add_argument('--record', action='store', metavar='FILE', help="record device API responses to an archive")
+cli.add_argument('--replay', action='store', metavar='FILE', help="serve device API responses from an archive")
+cli.add_argument('--replay-speed', action='store', type=float, default=1, help="replay speed factor, 0 without delays")
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 loghandler = logging.handlers.SysLogHandler(address = '/dev/log')
 log.addHandler(loghandler)
 
-if not args.self_metrics:
-  prom.REGISTRY.unregister(prom.PROCESS_COLLECTOR)
-  prom.REGISTRY.unregister(prom.PLATFORM_COLLECTOR)
-  prom.REGISTRY.unregister(prom.GC_COLLECTOR)
+class Session():
+  """ Authenticated Keenetic API session of a single target """
+
+  def __init__(self):
+    self.http = transport.session()
+    self.lock = threading.Lock()
+    self.expires = 0
+
+class Inventory():
+  """ Cached interface labels of a single target """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.interfaces = None
+    self.expires = 0
+    self.refreshing = False
+    # Reload in flight, shared by concurrent scrapes
+    self.flight = None
+    # Interfaces answering their statistics with an error status after the last reload
+    self.errors = set()
 
 class Keenetic():
   """ Keenetic API client class """
 
-  def __init__(self, configfile):
-    with open(configfile, encoding='utf-8') as f:
-      self.config = yaml.load(f, Loader=SafeLoader)
+  def __init__(self, config):
+    self.config = config
+
+    # Each router keeps its own session cookie
+    self.lifetime = (self.config.get('session') or {}).get('lifetime', LIFETIME)
+    self.sessions = {target: Session() for target in self.config['auth']}
+    self.pool = fanout.executor(name="keenetic")
+    self.recorder = recorder.Recorder()
+    self.inventories = {target: Inventory() for target in self.config['auth']}
 
-    self.session = requests.session()
+    # Metric families are compiled once from the config, interface statistics on first use
+    self.system_families = self.families("system", "Keenetic system metric")
+    self.hotspot_families = self.families("hotspot", "Keenetic hotspot summary metric")
+    self.stat_families = {}
 
   def auth(self, target):
     """ Keenetic session authentication for later use in API requests """
     ip = target
     username = self.config['auth'][target]['username']
     password = self.config['auth'][target]['password']
+    session = self.sessions[target]
+
+    with session.lock:
+      # Reuse the authenticated session cookie until its lifetime expired
+      if time.monotonic() < session.expires:
+        return True
+
+      try:
+        response = self.request(ip, 'auth')
+        if response.status_code == 401:
+          md5 = username + ':' + response.headers['X-NDM-Realm'] + ':' + password
+          md5 = hashlib.md5(md5.encode('utf-8'))
+          sha = response.headers['X-NDM-Challenge'] + md5.hexdigest()
+          sha = hashlib.sha256(sha.encode('utf-8'))
+          response = self.request(ip, "auth", {'login': username, 'password': sha.hexdigest()})
+      except requests.exceptions.RequestException as e:
+        log.error(e)
+        return False
 
-    try:
-      response = self.request(ip, 'auth')
-    except requests.exceptions.RequestException as e:
-      log.error(e)
-      return False
-
-    if response.status_code == 401:
-      md5 = username + ':' + response.headers['X-NDM-Realm'] + ':' + password
-      md5 = hashlib.md5(md5.encode('utf-8'))
-      sha = response.headers['X-NDM-Challenge'] + md5.hexdigest()
-      sha = hashlib.sha256(sha.encode('utf-8'))
-      response = self.request(ip, "auth", {'login': username, 'password': sha.hexdigest()})
       if response.status_code == 200:
+        session.expires = time.monotonic() + self.lifetime
         return True
-    elif response.status_code == 200:
-      return True
 
     return False
 
   def request(self, ip, query, post = None):
-    """ Sending a Keenetic API request to endpoint in 'query' """
+    """ Sending a Keenetic API request to endpoint in 'query', recorded or replayed if enabled """
+    return self.recorder.request(ip, query, partial(self.exchange, ip, query, post), post)
+
+  def exchange(self, ip, query, post = None):
+    """ Sending a Keenetic API request, authenticating again if the session was dropped """
+    session = self.sessions[ip]
+    response = self.send(session, ip, query, post)
+    if response.status_code == 401 and query != 'auth':
+      # Session was dropped by the router before its lifetime expired
+      session.expires = 0
+      if self.auth(ip):
+        response = self.send(session, ip, query, post)
+
+    return response
+
+  def send(self, session, ip, query, post = None):
+    """ Sending a single HTTP request within the session of target 'ip' """
     url = 'http://' + ip + '/' + query
+    # Requests are accounted by endpoint without their (per interface) parameters
+    endpoint = query.split("?")[0]
     if post:
-      return self.session.post(url, json=post)
+      return instrument.request(endpoint, session.http.post, url, json=post, timeout=TIMEOUT)
 
-    return self.session.get(url)
+    return instrument.request(endpoint, session.http.get, url, timeout=TIMEOUT)
 
-  def register(self, metrics, self_metrics=False):
-    """ Register a new Prometheus client registry """
-    class Collector():
-      """ Prometheus Client Collector class """
-      def collect(self):
-        """ Prometheus Client collect() function """
-        return metrics.values()
+  def batch(self, target, commands):
+    """
+      Sending several RCI commands in a single request (RCI batch mode)
+      Returns the list of command results in the order of 'commands'
+    """
+    response = self.request(target, "rci/", commands)
+    if response.status_code != 200:
+      raise requests.exceptions.HTTPError(f"RCI batch request returned {response.status_code}", response=response)
+    results = instrument.decode("rci/", response.content)
+    if not isinstance(results, list) or len(results) != len(commands):
+      raise ValueError("Unexpected RCI batch response")
 
-    registry = CollectorRegistry()
-    registry.register(Collector())
+    return results
 
-    if self_metrics:
-      registry.register(prom.PROCESS_COLLECTOR)
-      registry.register(prom.PLATFORM_COLLECTOR)
-      registry.register(prom.GC_COLLECTOR)
+  def stats(self, target, names):
+    """
+      Returning (statistics, errors) of all interfaces in 'names'
+      All interfaces are queried in one RCI batch request; if the router
+      rejects the batch, interfaces are queried concurrently instead.
+      'errors' are the interfaces answering with an error status, e.g.
+      removed or renamed since the inventory was loaded.
+    """
+    commands = [{"show": {"interface": {"stat": {"name": name}}}} for name in names]
+    if not commands:
+      return {}, set()
 
-    return registry
+    try:
+      results = self.batch(target, commands)
+    except (requests.exceptions.RequestException, ValueError) as e:
+      log.warning("RCI batch request to %s failed, falling back to single requests: %s", target, e)
+    else:
+      statistics = {}
+      for (name, r) in zip(names, results):
+        try:
+          statistics[name] = r["show"]["interface"]["stat"]
+        except (KeyError, TypeError):
+          # Error statuses are answered in place of the command's result
+          statistics[name] = r
+      return self.unpack(target, statistics)
+
+    def stat(name):
+      r = self.request(target, f"rci/show/interface/stat?name={name}")
+      return instrument.decode("rci/show/interface/stat", r.content)
+
+    calls = {name: partial(stat, name) for name in names}
+    results, failures = fanout.gather(self.pool, calls, TIMEOUT)
+    for (name, e) in failures.items():
+      log.error("Interface statistics of %s on %s failed: %s", name, target, e)
+
+    return self.unpack(target, results)
+
+  def unpack(self, target, results):
+    """ Returning (statistics, errors) of the statistics 'results' by interface name """
+    statistics = {}
+    errors = set()
+    for (name, r) in results.items():
+      # Unknown interfaces answer with an error status instead
+      if isinstance(r, dict) and "status" not in r:
+        statistics[name] = r
+      else:
+        log.warning("No interface statistics of %s on %s: %s", name, target, r)
+        errors.add(name)
+    return statistics, errors
+
+  def families(self, module, description):
+    """ Compiling the metric families of all configured metrics of 'module' """
+    metrics = (self.config["modules"].get(module) or {}).get("metrics") or []
+    return {metric: exposition.family(metric, f"{description} {metric}") for metric in metrics}
+
+  def stat(self, metric):
+    """ Returning the family of interface statistics field 'metric' """
+    family = self.stat_families.get(metric)
+    if family is None:
+      m = metric.replace("-", "_")
+      family = self.stat_families[metric] = exposition.family(m, f"Keenetic interface metric {metric}")
+    return family
 
   def system(self, target):
     """
-      Returning general system metrics
+      Returning the exposition of general system metrics
       API endpoint: rci/show/system
     """
-    result = b""
+    out = exposition.Exposition()
     if self.auth(target):
       r = self.request(target, "rci/show/system")
-      r = r.json()
+      r = instrument.decode("rci/show/system", r.content)
 
       labels = {}
       for label in self.config["modules"]["system"]["labels"]:
         labels[label] = r[label]
 
-      metrics = {}
-      for metric in self.config["modules"]["system"]["metrics"]:
-        metrics[metric] = Metric(metric, f"Keenetic system metric {metric}", "untyped")
-        metrics[metric].add_sample(metric, value=r[metric], labels=labels)
+      for (metric, family) in self.system_families.items():
+        out.add(family, r[metric], labels)
 
-      registry = self.register(metrics)
-      result = generate_latest(registry)
+    return out
 
-    return result
+  def interfaces(self, target):
+    """
+      Returning the labels of all interfaces with link 'up' keyed by interface name
+      API endpoint: rci/show/interface
+    """
+    interfaces = self.request(target, "rci/show/interface")
+    return self.labels(instrument.decode("rci/show/interface", interfaces.content))
+
+  def labels(self, interfaces):
+    """ Returning the labels of all interfaces with link 'up' in 'show interface' result 'interfaces' """
+    inventory = {}
+    for i in interfaces:
+      if interfaces[i]["link"] == "up":
+        labels = {}
+        for label in self.config["modules"]["interface"]["labels"]:
+          # Skipping labels not avaiable for an interface
+          if label in interfaces[i]:
+            labels[label.replace("-", "_")] = interfaces[i][label]
+        inventory[interfaces[i]['interface-name']] = labels
+
+    return inventory
+
+  def inventory(self, target):
+    """
+      Returning the cached interface inventory of 'target'
+      An expired inventory is refreshed in the background while the
+      previous one keeps being served.
+    """
+    inventory = self.inventories[target]
+    with inventory.lock:
+      if inventory.interfaces is not None:
+        if time.monotonic() >= inventory.expires and not inventory.refreshing:
+          inventory.refreshing = True
+          self.pool.submit(self.refresh, target)
+        return inventory.interfaces
+
+    return self.reload(target)
+
+  def reload(self, target):
+    """ Reloading the interface inventory of 'target' now, concurrent scrapes wait for a single request """
+    inventory = self.inventories[target]
+    with inventory.lock:
+      flight = inventory.flight
+      leader = flight is None
+      if leader:
+        flight = inventory.flight = cache.Flight()
+
+    if leader:
+      try:
+        flight.value = self.refresh(target)
+      except Exception as e: # pylint: disable=broad-exception-caught
+        # Raised in all waiting scrapes below
+        flight.error = e
+      with inventory.lock:
+        inventory.flight = None
+      flight.event.set()
+    else:
+      flight.event.wait()
+
+    if flight.error is not None:
+      raise flight.error
+    return flight.value
+
+  def refresh(self, target):
+    """ Loading the interface inventory of 'target' into the cache """
+    inventory = self.inventories[target]
+    try:
+      interfaces = self.interfaces(target)
+    except Exception as e:
+      log.error("Interface inventory of %s failed: %s", target, e)
+      raise
+    finally:
+      inventory.refreshing = False
+
+    ttl = self.config["modules"]["interface"].get("ttl", INVENTORY_TTL)
+    with inventory.lock:
+      inventory.interfaces = interfaces
+      inventory.expires = time.monotonic() + ttl
+      inventory.errors = set()
+    return interfaces
 
   def interface(self, target):
     """
-      Returning interface metrics for all interfaces found in 'state' == 'up'
-      API endpoint: rci/show/interface/<interface-name>
+      Returning the exposition of interface metrics for all interfaces found in 'state' == 'up'
+      Interface labels are taken from the cached inventory. Interfaces
+      answering their statistics with an error status (removed or renamed)
+      reload the inventory at once, other link state changes are picked up
+      when the inventory expires.
+      API endpoint: rci/ (batch of 'show interface stat')
     """
-    result = b""
+    # Samples of all interfaces are merged into one family per metric
+    out = exposition.Exposition()
     if self.auth(target):
-      interfaces = self.request(target, "rci/show/interface")
-      interfaces = interfaces.json()
-
-      # Get all interfaces with link "up"
-      for i in interfaces:
-        if interfaces[i]["link"] == "up":
-          name = interfaces[i]['interface-name']
-          stats = self.request(target, f"rci/show/interface/stat?name={name}")
-          stats = stats.json()
-
-          labels = {}
-          for label in self.config["modules"]["interface"]["labels"]:
-          # Skipping labels not avaiable for an interface
-            try:
-              l = label.replace("-", "_")
-              labels[l] = interfaces[i][label]
-            except KeyError:
-              continue
+      inventory = self.inventory(target)
+      statistics, errors = self.stats(target, list(inventory))
+
+      cached = self.inventories[target]
+      with cached.lock:
+        changed = errors != cached.errors
+      if changed:
+        current = self.reload(target)
+        with cached.lock:
+          # Interfaces failing in the reloaded inventory as well do not trigger further reloads
+          cached.errors = errors & set(current)
+        if current != inventory:
+          inventory = current
+          missing = [name for name in inventory if name not in statistics]
+          statistics.update(self.stats(target, missing)[0])
+
+      for (name, labels) in inventory.items():
+        if name in statistics:
+          stats = statistics[name]
 
           # Exposing all metrics found in interface statistics (no configuration)
-          metrics = {}
           for metric in stats:
-            m = metric.replace("-", "_")
-            metrics[m] = Metric(m, f"Keenetic interface metric {metric}", "untyped")
-            metrics[m].add_sample(m, value=stats[metric], labels=labels)
-
-          registry = self.register(metrics)
-          result = b"".join([result, generate_latest(registry)])
+            out.add(self.stat(metric), stats[metric], labels)
 
-    return result
+    return out
 
   def hotspot(self, target):
     """
@@ -191,84 +381,72 @@ class Keenetic():
       API endpoint: rci/show/ip/hotspot/summary?attribute=<metric>
     """
     result = b""
-    metrics = {}
 
-    for metric in self.config["modules"]["hotspot"]["metrics"]:
-      if self.auth(target):
-        clients = self.request(target, f"rci/show/ip/hotspot/summary?attribute={metric}")
-        clients = clients.json()['host']
+    if not self.auth(target):
+      return result
 
-        for client in clients:
-          labels = {}
-          for label in self.config["modules"]["hotspot"]["labels"]:
-            # Skip label if it does not exist
-            try:
-              labels[label] = client[label]
-            except KeyError:
-              continue
+    out = exposition.Exposition()
+    for (metric, family) in self.hotspot_families.items():
+      clients = self.request(target, f"rci/show/ip/hotspot/summary?attribute={metric}")
+      clients = instrument.decode("rci/show/ip/hotspot/summary", clients.content)['host']
 
-          metrics[metric] = Metric(metric, f"Keenetic hotspot summary metric {metric}", "untyped")
-          metrics[metric].add_sample(metric, value=client[metric], labels=labels)
+      for client in clients:
+        labels = {}
+        for label in self.config["modules"]["hotspot"]["labels"]:
+          # Skip label if it does not exist
+          try:
+            labels[label] = client[label]
+          except KeyError:
+            continue
 
-          registry = self.register(metrics)
-          result = b"".join([result, generate_latest(registry)])
+        out.add(family, client[metric], labels)
 
-    return result
+    return out.render()
 
-class Handler(BaseHTTPRequestHandler):
+class Handler(server.ExporterHandler):
   """ HTTP server request handler class """
 
-  keenetic = Keenetic(args.config)
-
-  # pylint: disable=invalid-name; Method provided by upstream class
-  def do_GET(self):
-    """ Provide data in Prometheus Exposition Format upon client request """
-    url = urisplit(self.path)
-
-    self.error_message_format = """
-      <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
-        "http://www.w3.org/TR/html4/strict.dtd">
-      <html>
-        <head>
-          <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
-          <title>Error response</title>
-        </head>
-        <body>
-          <h1>Error response</h1>
-          <p>Error code: %(code)d</p>
-          <p>Traceback: <pre>%(message)s</pre></p>
-          <p>Error code explanation: %(code)s - %(explain)s.</p>
-        </body>
-      </html>
-    """
+  keenetic = None
+  results = None
+  poller = None
+  scrapers = {'system': 'system', 'interface': 'interface'}
 
-    if url.path == '/favicon.ico': return
-    target = url.getquerydict().get('target')[0]
-    if target is None:
-      self.send_error(404, message="No target!", explain="No target specified in query ...")
-      return
-    # Prometheus is quering multiple modules in one request -> multiple 'module' params possible
-    modules = url.getquerydict().get('module')
-    if modules is None:
-      self.send_error(404, message="No module!", explain="No target specified in query ...")
-      return
-
-    metrics = b""
-    for module in modules:
-      if module == "system":
-        metrics = b"".join([metrics, self.keenetic.system(target)])
-      elif module == "interface":
-        metrics = b"".join([metrics, self.keenetic.interface(target)])
-      else:
-        trace = traceback.format_exc().strip()
-        self.send_error(404, message=trace, explain=f"Cannot find module {module}.")
+  @classmethod
+  def scraper(cls, target, module):
+    """ Return the function scraping 'module' of 'target' """
+    if module not in cls.scrapers:
+      raise server.HTTPError(404, message="No such module!", explain=f"Cannot find module {module}.")
+
+    return partial(getattr(cls.keenetic, cls.scrapers[module]), target)
 
-    self.send_response(200)
-    self.end_headers()
-    self.wfile.write(metrics)
+  def collect(self, target, modules):
+    """ Provide data in Prometheus Exposition Format for all requested modules """
+    if self.poller:
+      return self.poller.collect(target, modules)
+
+    # Families shared by several modules are rendered below a single header
+    out = exposition.Exposition()
+    for module in modules:
+      out.merge(self.results.get(target, module, self.scraper(target, module)))
+
+    self.results.expose(out, target)
+    return out.render()
+
+def plugin(options, config):
+  """ Set up the exporter with 'config' and the command line 'options', returns its handler """
+  Handler.keenetic = Keenetic(config)
+  Handler.targets = config['auth']
+  Handler.results = cache.Cache(config.get('cache'))
+  Handler.keenetic.recorder = recorder.Recorder(options.record, options.replay, options.replay_speed)
+  if options.poll:
+    jobs = poller.jobs(Handler.targets, config['modules'], Handler.scraper)
+    Handler.poller = poller.Poller(jobs, config.get('poll'))
+    Handler.poller.start()
+  return Handler
 
 if __name__ == '__main__':
-  address, port = args.listen.split(":")
-  print(f"Starting {PROGRAMNAME} on {address}:{port} ...")
-  server = HTTPServer((address, int(port)), Handler)
-  server.serve_forever()
+  args = cli.parse_args()
+  server.self_metrics(args.self_metrics)
+  handler = plugin(args, settings.load(args.config))
+  print(f"Starting {PROGRAMNAME} on {args.listen} ...")
+  server.serve(args.listen, handler, args.workers)
@@ -0,0 +1,3 @@
+"""
+Shared building blocks for the Prometheus exporters in this repository
+"""
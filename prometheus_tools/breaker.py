@@ -0,0 +1,112 @@
+"""
+Per-device circuit breaker with exponential backoff
+
+After 'threshold' consecutive failures a device is skipped and reported as
+down straight away. Once its backoff expired a single half-open probe is let
+through; a failing probe doubles the backoff up to 'max_backoff'.
+"""
+
+import threading
+import time
+
+from prometheus_tools import exposition
+
+CLOSED = 0
+OPEN = 1
+HALF_OPEN = 2
+
+THRESHOLD = 3
+BACKOFF = 30
+MAX_BACKOFF = 900
+
+STATE = exposition.family("breaker_state", "Circuit breaker state (0=closed, 1=open, 2=half-open)", "gauge")
+FAILURES = exposition.family("breaker_failures", "Consecutive failed requests to the device", "gauge")
+RETRY = exposition.family("breaker_retry_seconds", "Seconds until the next half-open probe", "gauge")
+
+class CircuitOpen(Exception):
+  """ Raised instead of contacting a device whose breaker is open """
+
+class CircuitBreaker():
+  """ Circuit breaker state of a single device """
+
+  def __init__(self, threshold=THRESHOLD, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+    self.threshold = threshold
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.lock = threading.Lock()
+    self.state = CLOSED
+    self.failures = 0
+    self.trips = 0
+    self.retry_at = 0
+
+  def allow(self):
+    """ Return True if the device may be contacted now """
+    with self.lock:
+      if self.state == CLOSED:
+        return True
+      if self.state == OPEN and time.monotonic() >= self.retry_at:
+        # Only one probe at a time, concurrent callers keep being rejected
+        self.state = HALF_OPEN
+        return True
+      return False
+
+  def success(self):
+    """ Record a successful request and close the breaker """
+    with self.lock:
+      self.state = CLOSED
+      self.failures = 0
+      self.trips = 0
+
+  def failure(self):
+    """ Record a failed request and open the breaker if required """
+    with self.lock:
+      self.failures += 1
+      if self.state == HALF_OPEN or self.failures >= self.threshold:
+        delay = min(self.backoff * 2 ** self.trips, self.max_backoff)
+        self.state = OPEN
+        self.trips += 1
+        self.retry_at = time.monotonic() + delay
+
+  def call(self, func, *args, **kwargs):
+    """ Call 'func' unless the breaker is open, recording its outcome """
+    if not self.allow():
+      raise CircuitOpen(f"Circuit open for another {self.retry_in():.0f}s")
+    try:
+      result = func(*args, **kwargs)
+    except Exception:
+      self.failure()
+      raise
+    self.success()
+    return result
+
+  def retry_in(self):
+    """ Seconds until the next half-open probe """
+    if self.state == CLOSED:
+      return 0
+    return max(self.retry_at - time.monotonic(), 0)
+
+class Breakers():
+  """ Registry of circuit breakers keyed by device address """
+
+  def __init__(self, config=None):
+    config = config or {}
+    self.threshold = config.get('threshold', THRESHOLD)
+    self.backoff = config.get('backoff', BACKOFF)
+    self.max_backoff = config.get('max_backoff', MAX_BACKOFF)
+    self.lock = threading.Lock()
+    self.breakers = {}
+
+  def __getitem__(self, device):
+    with self.lock:
+      if device not in self.breakers:
+        self.breakers[device] = CircuitBreaker(self.threshold, self.backoff, self.max_backoff)
+      return self.breakers[device]
+
+  def expose(self, out, devices):
+    """ Add breaker state metrics of 'devices' to exposition 'out' """
+    for device in devices:
+      breaker = self[device]
+      labels = {'device': device}
+      out.add(STATE, breaker.state, labels)
+      out.add(FAILURES, breaker.failures, labels)
+      out.add(RETRY, breaker.retry_in(), labels)
@@ -0,0 +1,135 @@
+"""
+Scrape result cache with request coalescing
+
+Results are cached per (target, module) for a short TTL. Concurrent identical
+scrapes wait for the single upstream request in flight instead of sending
+their own (single-flight). Optionally an expired result is served for another
+'stale' seconds while it is refreshed in the background.
+
+Config file format:
+
+cache:
+  ttl: 5
+  stale: 0
+  modules:
+    <module>:
+      ttl: 10
+      stale: 30
+"""
+
+import syslog
+import threading
+import time
+
+from prometheus_tools import exposition, fanout
+
+TTL = 5
+STALE = 0
+
+REQUESTS = exposition.family("cache_requests", "Scrape cache lookups by result", "counter")
+
+class Flight():
+  """ Upstream request in flight, shared by all waiting scrapes """
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.value = None
+    self.error = None
+
+class Entry():
+  """ Cached scrape result """
+
+  def __init__(self, value, expires, stale):
+    self.value = value
+    self.expires = expires
+    self.stale = stale
+
+class Cache():
+  """ Per-(target, module) scrape result cache """
+
+  def __init__(self, config=None):
+    config = config or {}
+    self.ttl = config.get('ttl', TTL)
+    self.stale = config.get('stale', STALE)
+    self.modules = config.get('modules') or {}
+    self.lock = threading.Lock()
+    self.entries = {}
+    self.flights = {}
+    self.counters = {}
+    self.pool = None
+
+  def lifetime(self, module):
+    """ Return (ttl, stale) seconds of 'module' """
+    config = self.modules.get(module) or {}
+    return config.get('ttl', self.ttl), config.get('stale', self.stale)
+
+  def get(self, target, module, func):
+    """ Return the cached result of func() for (target, module) """
+    key = (target, module)
+    ttl, stale = self.lifetime(module)
+    if ttl <= 0 and stale <= 0:
+      return func()
+
+    with self.lock:
+      now = time.monotonic()
+      entry = self.entries.get(key)
+      if entry and now < entry.expires:
+        self.count(key, "hit")
+        return entry.value
+
+      if entry and now < entry.stale:
+        self.count(key, "stale")
+        if key not in self.flights:
+          self.flights[key] = Flight()
+          if self.pool is None:
+            self.pool = fanout.executor(name="cache")
+          self.pool.submit(self.refresh, key, func, self.flights[key], ttl, stale)
+        return entry.value
+
+      flight = self.flights.get(key)
+      leader = flight is None
+      if leader:
+        self.count(key, "miss")
+        flight = self.flights[key] = Flight()
+      else:
+        self.count(key, "coalesced")
+
+    if leader:
+      self.run(key, func, flight, ttl, stale)
+    else:
+      flight.event.wait()
+
+    if flight.error is not None:
+      raise flight.error
+    return flight.value
+
+  def refresh(self, key, func, flight, ttl, stale):
+    """ Refresh a stale entry in the background, failures are logged as no scrape waits for them """
+    self.run(key, func, flight, ttl, stale)
+    if flight.error is not None:
+      syslog.syslog(syslog.LOG_ERR, f"Background refresh of {key[1]} on {key[0]} failed: {flight.error!r}")
+
+  def run(self, key, func, flight, ttl, stale):
+    """ Send the upstream request and hand its result to all waiting scrapes """
+    try:
+      flight.value = func()
+    except Exception as e: # pylint: disable=broad-exception-caught
+      # Errors are passed to the waiting scrapes but never cached
+      flight.error = e
+    with self.lock:
+      if flight.error is None:
+        now = time.monotonic()
+        self.entries[key] = Entry(flight.value, now + ttl, now + ttl + stale)
+      del self.flights[key]
+    flight.event.set()
+
+  def count(self, key, result):
+    """ Count a cache lookup, caller holds the lock """
+    self.counters[key + (result,)] = self.counters.get(key + (result,), 0) + 1
+
+  def expose(self, out, target):
+    """ Add cache counters of all modules of 'target' to exposition 'out' """
+    with self.lock:
+      counters = [(k, v) for (k, v) in self.counters.items() if k[0] == target]
+    for ((_, module, result), value) in sorted(counters):
+      out.add(REQUESTS, value, {'module': module, 'result': result})
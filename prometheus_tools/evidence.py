@@ -0,0 +1,149 @@
+"""
+Evidence store for RTR-Netztest screenshots
+
+Screenshots are handed over in memory and written by a background thread, so
+a run is never delayed by image processing or disk I/O. Images are downscaled
+and recompressed (WebP by default, requires Pillow; without it the PNG is
+kept as is) and stored under their content hash, identical screenshots of a
+day are stored once. An SQLite index maps every run (timestamp, result values) to its
+file. After each write the retention policy removes the oldest evidence
+beyond 'days' or 'size' (MB).
+
+Config file format:
+
+evidence:
+  directory: /var/www/html/evidence
+  format: webp
+  quality: 75
+  scale: 0.5
+  days: 90
+  size: 500
+"""
+
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import syslog
+import threading
+import time
+from datetime import date
+
+from prometheus_tools import fanout
+
+DIRECTORY = "/var/www/html/evidence"
+FORMAT = "webp"
+QUALITY = 75
+SCALE = 0.5
+DAYS = 90
+SIZE = 500
+
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS evidence (
+    timestamp REAL NOT NULL,
+    results TEXT NOT NULL,
+    file TEXT NOT NULL,
+    bytes INTEGER NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS evidence_timestamp ON evidence (timestamp);
+  CREATE INDEX IF NOT EXISTS evidence_file ON evidence (file);
+"""
+
+def compress(png, image_format, quality, scale):
+  """ Return (data, extension) of the downscaled and recompressed 'png' """
+  try:
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+  except ImportError:
+    return png, "png"
+
+  with Image.open(io.BytesIO(png)) as image:
+    if scale != 1:
+      image = image.resize((max(round(image.width * scale), 1), max(round(image.height * scale), 1)))
+    if image_format == "jpeg":
+      image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, format=image_format, quality=quality)
+  return out.getvalue(), image_format
+
+class Evidence():
+  """ Asynchronous, deduplicated screenshot store with an index and retention """
+
+  def __init__(self, config=None):
+    config = config or {}
+    self.directory = config.get('directory', DIRECTORY)
+    self.format = config.get('format', FORMAT)
+    self.quality = config.get('quality', QUALITY)
+    self.scale = config.get('scale', SCALE)
+    self.days = config.get('days', DAYS)
+    self.size = config.get('size', SIZE) * 1024 * 1024
+    os.makedirs(self.directory, exist_ok=True)
+    self.db = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), check_same_thread=False)
+    self.db.executescript(SCHEMA)
+    self.lock = threading.Lock()
+    # A single writer keeps index and files consistent
+    self.pool = fanout.executor(1, name="evidence")
+
+  def submit(self, png, results, timestamp=None):
+    """ Store screenshot 'png' of a run with 'results' in the background """
+    self.pool.submit(self.save, png, results, timestamp or time.time())
+
+  def close(self):
+    """ Wait for pending screenshots to be stored """
+    self.pool.shutdown(wait=True)
+
+  def save(self, png, results, timestamp):
+    """ Store a screenshot within the background thread, logging failures nobody waits for """
+    try:
+      self.store(png, results, timestamp)
+    except Exception as e: # pylint: disable=broad-exception-caught
+      # The run has been reported already, losing its evidence must not go unnoticed
+      syslog.syslog(syslog.LOG_ERR, f"Storing evidence of run at {timestamp:.0f} failed: {e!r}")
+
+  def store(self, png, results, timestamp):
+    """ Compress, write and index a screenshot, then apply the retention policy """
+    data, extension = compress(png, self.format, self.quality, self.scale)
+    name = os.path.join(str(date.fromtimestamp(timestamp)), hashlib.sha256(data).hexdigest()[:32] + "." + extension)
+    path = os.path.join(self.directory, name)
+    if not os.path.exists(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path + ".tmp", "wb") as f:
+        f.write(data)
+      os.replace(path + ".tmp", path)
+
+    with self.lock, self.db:
+      self.db.execute("INSERT INTO evidence VALUES (?, ?, ?, ?)",
+        (timestamp, json.dumps(results, default=str), name, len(data)))
+    self.expire()
+
+  def expire(self):
+    """ Remove evidence older than 'days' and the oldest beyond 'size' bytes """
+    with self.lock, self.db:
+      cutoff = time.time() - self.days * 86400
+      expired = set()
+      total = 0
+      files = self.db.execute("SELECT file, bytes, MAX(timestamp) FROM evidence GROUP BY file ORDER BY 3 DESC")
+      for (name, size, timestamp) in files:
+        total += size
+        # The latest screenshot is always kept
+        if (total > self.size and total > size) or timestamp < cutoff:
+          expired.add(name)
+      self.db.executemany("DELETE FROM evidence WHERE file = ?", [(name,) for name in expired])
+
+    # Only files no longer indexed are removed, evidence written by older versions is left alone
+    for name in expired:
+      path = os.path.join(self.directory, name)
+      try:
+        os.remove(path)
+        if not os.listdir(os.path.dirname(path)):
+          os.rmdir(os.path.dirname(path))
+      except FileNotFoundError:
+        pass
+
+  def lookup(self, since, until=None):
+    """ Return (timestamp, results, file) of all runs between 'since' and 'until' """
+    with self.lock:
+      rows = self.db.execute("SELECT timestamp, results, file FROM evidence WHERE timestamp BETWEEN ? AND ? "
+        "ORDER BY timestamp", (since, until or time.time())).fetchall()
+    return [(timestamp, json.loads(results), name) for (timestamp, results, name) in rows]
@@ -0,0 +1,145 @@
+"""
+Pre-compiled Prometheus text exposition rendering
+
+Metric families (HELP/TYPE header) are compiled once and reused for every
+scrape. A scrape only renders the sample lines into a buffer per family, so
+samples of the same family (e.g. of several interfaces or hotspot clients)
+are merged below a single header. Expositions of several modules are merged
+before rendering for the same reason.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from prometheus_client.utils import floatToGoString
+
+LABELS_CACHE = 4096
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Collection timestamp of the samples added by a thread, see timestamped()
+_collection = threading.local()
+
+class Family():
+  """ Compiled metric family """
+
+  __slots__ = ('name', 'sample', 'header')
+
+  def __init__(self, name, documentation, metrictype="untyped"):
+    # Prometheus text format names counters with their '_total' suffix
+    if metrictype == "counter":
+      name = name + "_total"
+    documentation = documentation.replace('\\', r'\\').replace('\n', r'\n')
+    self.name = name
+    self.sample = name.encode('utf-8')
+    self.header = f"# HELP {name} {documentation}\n# TYPE {name} {metrictype}\n".encode('utf-8')
+
+@lru_cache(maxsize=None)
+def family(name, documentation, metrictype="untyped"):
+  """ Return the compiled family, compiling it on first use """
+  return Family(name, documentation, metrictype)
+
+@lru_cache(maxsize=LABELS_CACHE)
+def _labels(items):
+  """ Render sorted (name, value) label pairs """
+  if not items:
+    return b""
+  labels = ','.join(
+    '{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')) for (k, v) in items
+  )
+  return f"{{{labels}}}".encode('utf-8')
+
+def render_labels(values):
+  """ Return the rendered label set of dict 'values' """
+  if not values:
+    return b""
+  items = tuple(sorted(values.items()))
+  try:
+    return _labels(items)
+  except TypeError:
+    # Unhashable label values are rendered without caching
+    return _labels.__wrapped__(items)
+
+@contextmanager
+def timestamped(timestamp):
+  """ Samples added by this thread without a timestamp of their own carry 'timestamp' (seconds) """
+  _collection.timestamp = timestamp
+  try:
+    yield
+  finally:
+    _collection.timestamp = None
+
+class Exposition():
+  """ Buffer of sample lines grouped by metric family """
+
+  def __init__(self, labels=None):
+    """ 'labels' are added to every sample, e.g. the target of a fleet probe """
+    self.families = {}
+    self.labels = labels or {}
+
+  def add(self, metric, value, labels=None, timestamp=None, suffix=b""):
+    """ Add a sample of compiled family 'metric' with dict 'labels', e.g. suffix b"_count" of a histogram """
+    buffer = self.families.get(metric)
+    if buffer is None:
+      buffer = self.families[metric] = bytearray(metric.header)
+    if self.labels:
+      labels = {**self.labels, **labels} if labels else self.labels
+    buffer += metric.sample
+    buffer += suffix
+    buffer += render_labels(labels)
+    buffer += b" "
+    buffer += floatToGoString(value).encode('ascii')
+    if timestamp is None:
+      timestamp = getattr(_collection, 'timestamp', None)
+    if timestamp is not None:
+      buffer += b" %d" % int(timestamp * 1000)
+    buffer += b"\n"
+
+  def merge(self, other):
+    """ Merge the samples of exposition 'other' into this one """
+    for (metric, buffer) in other.families.items():
+      if metric in self.families:
+        self.families[metric] += memoryview(buffer)[len(metric.header):]
+      else:
+        self.families[metric] = bytearray(buffer)
+
+  def render(self):
+    """ Return all families in Prometheus Exposition Format """
+    start = time.perf_counter()
+    result = b"".join(self.families.values())
+    RENDER.observe(time.perf_counter() - start)
+    return result
+
+class Histogram():
+  """ Thread-safe cumulative histogram of observed values, e.g. durations in seconds """
+
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * len(self.buckets)
+    self.count = 0
+    self.sum = 0.0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    """ Record a single observation """
+    with self.lock:
+      for (i, bound) in enumerate(self.buckets):
+        if value <= bound:
+          self.counts[i] += 1
+      self.count += 1
+      self.sum += value
+
+  def expose(self, out, metric, labels=None):
+    """ Add the histogram as samples of family 'metric' (type histogram) to exposition 'out' """
+    labels = labels or {}
+    with self.lock:
+      counts, count, total = list(self.counts), self.count, self.sum
+    for (bound, value) in zip(self.buckets, counts):
+      out.add(metric, value, {**labels, 'le': floatToGoString(bound)}, suffix=b"_bucket")
+    out.add(metric, count, {**labels, 'le': "+Inf"}, suffix=b"_bucket")
+    out.add(metric, total, labels, suffix=b"_sum")
+    out.add(metric, count, labels, suffix=b"_count")
+
+# Render times of all expositions, served by instrument
+RENDER = Histogram((.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1))
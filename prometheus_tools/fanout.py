@@ -0,0 +1,74 @@
+"""
+Concurrent fan-out of upstream requests under a common deadline
+"""
+
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+WORKERS = 8
+
+def executor(workers=WORKERS, name="fanout"):
+  """ Return a bounded thread pool for upstream requests """
+  return ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+def gather(pool, calls, deadline):
+  """
+    Run all callables in 'calls' (key -> callable) concurrently on 'pool'
+    and wait at most 'deadline' seconds for them to finish.
+    Returns a tuple (results, failures) of dicts keyed like 'calls'. Calls
+    missing the deadline are reported in 'failures' with a TimeoutError.
+  """
+  futures = {pool.submit(call): key for (key, call) in calls.items()}
+  done, pending = wait(futures, timeout=deadline)
+
+  results = {}
+  failures = {}
+  for future in done:
+    key = futures[future]
+    if future.exception() is None:
+      results[key] = future.result()
+    else:
+      failures[key] = future.exception()
+  for future in pending:
+    # Requests already running finish in the background and are discarded
+    future.cancel()
+    failures[futures[future]] = TimeoutError(f"No answer within {deadline}s")
+
+  return results, failures
+
+def hedge(pool, calls, delay, deadline):
+  """
+    Run the callables in 'calls' (list of (key, callable)) one after another
+    on 'pool', starting the next one if no call succeeded within 'delay'
+    seconds or as soon as one failed. Returns (key, result) of the first call
+    succeeding within 'deadline' seconds or None, and a dict of failures.
+  """
+  start = time.monotonic()
+  queue = list(calls)
+  running = {}
+  failures = {}
+  launched = start
+  while queue or running:
+    now = time.monotonic()
+    if queue and (not running or now - launched >= delay):
+      key, call = queue.pop(0)
+      running[pool.submit(call)] = key
+      launched = now
+    remaining = deadline - (now - start)
+    if remaining <= 0:
+      break
+    timeout = min(remaining, launched + delay - now) if queue else remaining
+    done, _ = wait(running, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+    for future in done:
+      key = running.pop(future)
+      if future.exception() is None:
+        for other in running:
+          other.cancel()
+        return (key, future.result()), failures
+      failures[key] = future.exception()
+
+  for (future, key) in running.items():
+    # Calls still running finish in the background and are discarded
+    future.cancel()
+    failures[key] = TimeoutError(f"No answer within {deadline}s")
+  return None, failures
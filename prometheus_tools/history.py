@@ -0,0 +1,124 @@
+"""
+Local SQLite history of RTR-Netztest results
+
+Every run is appended to the 'runs' table. Its provider's statistics of that
+day are recomputed right away, p5/p50/p95 per metric into the 'daily' table
+and the number of runs per configured quality level into the 'levels' table,
+so serving them never scans the raw runs.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+from prometheus_tools import exposition
+
+METRICS = ("download", "upload", "ping")
+PERCENTILES = (5, 50, 95)
+DAYS = 30
+
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS runs (
+    timestamp REAL NOT NULL,
+    day TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    download REAL NOT NULL,
+    upload REAL NOT NULL,
+    ping REAL NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS runs_day ON runs (day, provider);
+  CREATE TABLE IF NOT EXISTS daily (
+    day TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    runs INTEGER NOT NULL,
+    p5 REAL NOT NULL,
+    p50 REAL NOT NULL,
+    p95 REAL NOT NULL,
+    PRIMARY KEY (day, provider, metric)
+  );
+  CREATE TABLE IF NOT EXISTS levels (
+    day TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    quality TEXT NOT NULL,
+    runs INTEGER NOT NULL,
+    PRIMARY KEY (day, provider, metric, quality)
+  );
+"""
+
+QUANTILE = exposition.family("netztest_quantile", "Daily quantile of RTR-Netztest results", "gauge")
+QUALITY = exposition.family("netztest_quality_runs", "Daily number of RTR-Netztest runs per quality level", "gauge")
+RUNS = exposition.family("netztest_runs", "Daily number of RTR-Netztest runs", "gauge")
+
+def quality(levels, value):
+  """
+    Return the quality level of 'value' within threshold 'levels' or None below all of them
+    A level covers its lower bound up to the next greater lower bound, so the levels leave no gaps
+  """
+  level = None
+  for (name, bounds) in sorted(levels.items(), key=lambda item: item[1]['lower']):
+    if bounds['lower'] > value:
+      break
+    level = name
+  return level
+
+def percentile(values, p):
+  """ Linearly interpolated percentile 'p' of sorted 'values' """
+  position = (len(values) - 1) * p / 100
+  lower = int(position)
+  upper = min(lower + 1, len(values) - 1)
+  return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+class History():
+  """ Results store shared by the test runner (writer) and the exporter (reader) """
+
+  def __init__(self, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.executescript(SCHEMA)
+    self.lock = threading.Lock()
+
+  def append(self, provider, ip, values, thresholds, timestamp=None):
+    """ Store the 'values' of one run and update the daily statistics of 'provider' """
+    timestamp = timestamp or time.time()
+    day = str(date.fromtimestamp(timestamp))
+    with self.lock, self.db:
+      self.db.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (timestamp, day, provider, ip, *(values[metric] for metric in METRICS)))
+      for metric in METRICS:
+        samples = sorted(row[0] for row in self.db.execute(
+          f"SELECT {metric} FROM runs WHERE day = ? AND provider = ?", (day, provider)))
+        self.db.execute("INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?, ?, ?)",
+          (day, provider, metric, len(samples), *(percentile(samples, p) for p in PERCENTILES)))
+
+        # All configured levels get a row, also those without runs
+        counts = dict.fromkeys(thresholds[metric], 0)
+        for sample in samples:
+          level = quality(thresholds[metric], sample)
+          if level is not None:
+            counts[level] += 1
+        # Levels of an earlier config are dropped
+        self.db.execute("DELETE FROM levels WHERE day = ? AND provider = ? AND metric = ?", (day, provider, metric))
+        self.db.executemany("INSERT INTO levels VALUES (?, ?, ?, ?, ?)",
+          [(day, provider, metric, level, count) for (level, count) in counts.items()])
+
+  def expose(self, out, days=DAYS):
+    """ Add the daily statistics of the last 'days' days to exposition 'out' """
+    since = str(date.today() - timedelta(days=days))
+    with self.lock:
+      rows = self.db.execute("SELECT * FROM daily WHERE day > ? ORDER BY day, provider, metric", (since,)).fetchall()
+      levels = self.db.execute("SELECT * FROM levels WHERE day > ? ORDER BY day, provider, metric, quality",
+        (since,)).fetchall()
+
+    for (day, provider, metric, runs, *stats) in rows:
+      labels = {'date': day, 'provider': provider}
+      if metric == METRICS[0]:
+        out.add(RUNS, runs, labels)
+      for (p, value) in zip(PERCENTILES, stats):
+        out.add(QUANTILE, value, {**labels, 'metric': metric, 'quantile': str(p / 100)})
+    for (day, provider, metric, level, count) in levels:
+      out.add(QUALITY, count, {'date': day, 'provider': provider, 'metric': metric, 'quality': level})
@@ -0,0 +1,121 @@
+"""
+Multi-exporter host
+
+Runs several exporters as plugins in a single process. They share the HTTP
+server and its workers, the connection pool to devices (transport), the
+config loader (settings) and the self-metrics on /metrics. Plugins are
+registered by name with the location of their exporter script and are only
+imported when enabled in the host config, so unused exporters cost nothing
+at startup. An exporter script is a plugin if it provides 'cli' (its
+argparse parser) and plugin(options, config) returning its configured
+handler class.
+
+Each plugin is probed on its own path '/<plugin>?target=<target>&module=<module>'
+and serves its additional routes below, e.g. '/tasmota/probe_all'. Probes
+on any other path are dispatched by their modules to the plugin scraping
+them.
+
+Config file format:
+
+plugins:
+  fronius:
+    config: /etc/prometheus/fronius-exporter.conf
+    args: [--poll]
+  public-ip:
+    # Exporter configs may be inlined
+    config:
+      target:
+        ipinfo.io:
+          url: https://ipinfo.io/json
+  <name>:
+    # Exporter scripts not in the registry
+    path: /usr/local/lib/my-exporter.py
+    config: /etc/prometheus/my-exporter.conf
+"""
+
+import importlib.util
+import os
+import sys
+
+from prometheus_tools import server, settings
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+
+# Exporter scripts by plugin name, relative to the repository
+PLUGINS = {
+  'fronius': "fronius-exporter/fronius-exporter.py",
+  'tasmota': "tasmota-exporter/tasmota-exporter.py",
+  'keenetic': "keenetic-api-exporter/prometheus-keenetic-api-exporter.py",
+  'public-ip': "public-ip-exporter/prometheus-public-ip-exporter.py",
+}
+
+def register(name, path):
+  """ Register the exporter script at 'path' as plugin 'name' """
+  PLUGINS[name] = path
+
+def load(name):
+  """ Import the exporter script of plugin 'name' """
+  if name not in PLUGINS:
+    raise KeyError(f"No plugin {name} registered")
+  spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, PLUGINS[name]))
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[name] = module
+  spec.loader.exec_module(module)
+  return module
+
+class Plugin():
+  """ Exporter running in the host """
+
+  def __init__(self, name, config):
+    if config.get('path'):
+      register(name, config['path'])
+    module = load(name)
+    options = module.cli.parse_args([str(arg) for arg in config.get('args') or []])
+    self.handler = module.plugin(options, settings.load(config['config']))
+    # Handler routes only depend on class state, so a plugin answers without a connection of its own
+    self.view = self.handler.__new__(self.handler)
+
+class Handler(server.ExporterHandler):
+  """ HTTP server request handler dispatching to the plugins """
+
+  plugins = {}
+  # Plugins by the modules they scrape
+  owners = {}
+
+  def dispatch(self, path, query_params):
+    name, _, route = path.strip("/").partition("/")
+    if name in self.plugins:
+      return self.plugins[name].view.dispatch("/" + route, query_params)
+    if path in self.routes:
+      return super().dispatch(path, query_params)
+
+    return self.plugin(query_params).view.dispatch(path, query_params)
+
+  def plugin(self, query_params):
+    """ Return the plugin scraping all modules of a probe """
+    modules = query_params.get('module')
+    if modules is None:
+      raise server.HTTPError(404, message="No module!", explain="No module specified in query ...")
+
+    names = set()
+    for module in modules:
+      owners = self.owners.get(module, set())
+      if len(owners) != 1:
+        # Modules of several plugins are probed on the plugin's path
+        raise server.HTTPError(404, message="No such module!",
+          explain=f"Cannot find a single plugin of module {module}, probe /<plugin> instead.")
+      names |= owners
+    if len(names) > 1:
+      raise server.HTTPError(404, message="Modules of several plugins!",
+        explain=f"Modules {', '.join(modules)} are scraped by {', '.join(sorted(names))}.")
+
+    return self.plugins[names.pop()]
+
+def setup(config):
+  """ Load and set up the plugins enabled in 'config', returns the host's handler class """
+  for (name, section) in (config.get('plugins') or {}).items():
+    plugin = Plugin(name, section or {})
+    Handler.plugins[name] = plugin
+    for module in plugin.handler.modules():
+      Handler.owners.setdefault(module, set()).add(name)
+  return Handler
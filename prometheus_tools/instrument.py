@@ -0,0 +1,100 @@
+"""
+Built-in self-metrics of the exporters
+
+Scrape durations per target and module, upstream requests per endpoint
+(count, latency, response bytes), JSON decode and exposition render times
+and errors by class are recorded in memory and served on /metrics, separate
+from the probes of devices.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_tools import exposition
+
+SCRAPE = exposition.family("exporter_scrape_duration_seconds", "Duration of probes by target and module", "histogram")
+UPSTREAM = exposition.family("exporter_upstream_request_duration_seconds",
+  "Duration of upstream requests by endpoint", "histogram")
+BYTES = exposition.family("exporter_upstream_response_bytes", "Bytes received from upstream by endpoint", "counter")
+DECODE = exposition.family("exporter_json_decode_duration_seconds", "Duration of JSON decoding by endpoint", "histogram")
+RENDER = exposition.family("exporter_render_duration_seconds", "Duration of exposition rendering", "histogram")
+ERRORS = exposition.family("exporter_errors", "Errors by stage and class", "counter")
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+def histogram(family, **labels):
+  """ Return the histogram of 'family' with 'labels', created on first use """
+  key = (family, tuple(sorted(labels.items())))
+  with _lock:
+    result = _histograms.get(key)
+    if result is None:
+      result = _histograms[key] = exposition.Histogram()
+  return result
+
+def count(family, value=1, **labels):
+  """ Increase the counter of 'family' with 'labels' by 'value' """
+  key = (family, tuple(sorted(labels.items())))
+  with _lock:
+    _counters[key] = _counters.get(key, 0) + value
+
+def error(stage, e):
+  """ Count error 'e' raised in 'stage' """
+  count(ERRORS, stage=stage, **{'class': type(e).__name__})
+
+@contextmanager
+def scrape(target, modules):
+  """ Time the probe of 'modules' of 'target' """
+  start = time.perf_counter()
+  try:
+    yield
+  except Exception as e:
+    error("scrape", e)
+    raise
+  finally:
+    histogram(SCRAPE, target=target, module="+".join(modules or [])).observe(time.perf_counter() - start)
+
+def request(endpoint, func, *args, **kwargs):
+  """ Call 'func' sending an upstream request to 'endpoint', recording latency and response size """
+  start = time.perf_counter()
+  try:
+    response = func(*args, **kwargs)
+  except Exception as e:
+    error("upstream", e)
+    raise
+  finally:
+    histogram(UPSTREAM, endpoint=endpoint).observe(time.perf_counter() - start)
+
+  content = getattr(response, 'content', None)
+  if content is not None:
+    count(BYTES, len(content), endpoint=endpoint)
+  if getattr(response, 'status_code', 200) >= 400:
+    count(ERRORS, stage="upstream", **{'class': f"HTTP{response.status_code}"})
+  return response
+
+def decode(endpoint, content):
+  """ Return the decoded JSON 'content' of 'endpoint', recording the decode time """
+  start = time.perf_counter()
+  try:
+    return json.loads(content)
+  except ValueError as e:
+    error("decode", e)
+    raise
+  finally:
+    histogram(DECODE, endpoint=endpoint).observe(time.perf_counter() - start)
+
+def render():
+  """ Return all self-metrics in Prometheus Exposition Format """
+  out = exposition.Exposition()
+  with _lock:
+    histograms = sorted(_histograms.items(), key=lambda item: (item[0][0].name, item[0][1]))
+    counters = sorted(_counters.items(), key=lambda item: (item[0][0].name, item[0][1]))
+  for ((family, labels), value) in histograms:
+    value.expose(out, family, dict(labels))
+  exposition.RENDER.expose(out, RENDER)
+  for ((family, labels), value) in counters:
+    out.add(family, value, dict(labels))
+  return out.render()
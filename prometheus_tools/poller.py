@@ -0,0 +1,135 @@
+"""
+Background polling mode
+
+Every configured (target, module) is polled on its own interval and the
+rendered exposition is kept in memory. Scrapes are answered from these
+snapshots only, so scrape latency no longer depends on the devices. Each
+sample carries its collection timestamp unless the exporter set its own, and
+snapshot age and success are exposed as additional series.
+
+Config file format:
+
+poll:
+  interval: 15
+  modules:
+    <module>:
+      interval: 60
+"""
+
+import heapq
+import random
+import syslog
+import threading
+import time
+
+from prometheus_tools import exposition, fanout
+from prometheus_tools.server import HTTPError
+
+INTERVAL = 15
+
+AGE = exposition.family("snapshot_age_seconds", "Seconds since the snapshot was collected", "gauge")
+SUCCESS = exposition.family("snapshot_success", "Last poll of the module succeeded", "gauge")
+DURATION = exposition.family("snapshot_duration_seconds", "Duration of the last poll", "gauge")
+
+class Snapshot():
+  """ Latest result of a (target, module) """
+
+  def __init__(self):
+    self.exposition = None
+    self.timestamp = 0
+    self.duration = 0
+    self.success = False
+
+class Poller():
+  """ Scheduler polling all jobs in the background """
+
+  def __init__(self, scrapes, config=None, workers=fanout.WORKERS):
+    """ 'scrapes' maps (target, module) to a callable returning an Exposition """
+    config = config or {}
+    self.jobs = scrapes
+    self.interval = config.get('interval', INTERVAL)
+    self.modules = config.get('modules') or {}
+    self.snapshots = {key: Snapshot() for key in scrapes}
+    self.running = set()
+    self.lock = threading.Lock()
+    self.pool = fanout.executor(workers, name="poll")
+
+  def period(self, module):
+    """ Return the polling interval of 'module' """
+    return (self.modules.get(module) or {}).get('interval', self.interval)
+
+  def start(self):
+    """ Start polling in a background thread """
+    threading.Thread(target=self.schedule, name="scheduler", daemon=True).start()
+
+  def schedule(self):
+    """ Run each job on its interval, first runs are spread over one interval """
+    now = time.monotonic()
+    queue = [(now + random.uniform(0, self.period(key[1])), key) for key in self.jobs]
+    heapq.heapify(queue)
+    while True:
+      due, key = heapq.heappop(queue)
+      time.sleep(max(due - time.monotonic(), 0))
+      with self.lock:
+        # Skip a run if the previous one is still in progress
+        if key not in self.running:
+          self.running.add(key)
+          self.pool.submit(self.poll, key)
+      heapq.heappush(queue, (due + self.period(key[1]), key))
+
+  def poll(self, key):
+    """ Run a single job and store its result """
+    snapshot = self.snapshots[key]
+    start = time.time()
+    try:
+      with exposition.timestamped(start):
+        result = self.jobs[key]()
+    except Exception as e: # pylint: disable=broad-exception-caught
+      # The previous snapshot is kept and marked as failed
+      syslog.syslog(syslog.LOG_ERR, f"Poll of {key[1]} on {key[0]} failed: {e!r}")
+      snapshot.success = False
+    else:
+      snapshot.exposition = result
+      snapshot.timestamp = start
+      snapshot.success = True
+    finally:
+      snapshot.duration = time.time() - start
+      with self.lock:
+        self.running.discard(key)
+
+  def collect(self, target, modules):
+    """ Return the snapshots of all requested modules of 'target' merged into one exposition """
+    out = exposition.Exposition()
+    for module in modules or [None]:
+      if (target, module) not in self.snapshots:
+        raise HTTPError(404, message="No such module!", explain=f"Module {module} is not polled.")
+      snapshot = self.snapshots[(target, module)]
+      if snapshot.exposition is None:
+        raise HTTPError(503, message="No data!", explain=f"Module {module} not polled successfully yet.")
+      # Families shared by several modules are rendered below a single header
+      out.merge(snapshot.exposition)
+
+    self.expose(out, target, modules or [None])
+    return out.render()
+
+  def expose(self, out, target, modules):
+    """ Add snapshot staleness metrics of 'target' to exposition 'out' """
+    now = time.time()
+    for module in modules:
+      snapshot = self.snapshots[(target, module)]
+      labels = {'module': module or ""}
+      out.add(AGE, now - snapshot.timestamp, labels)
+      out.add(SUCCESS, int(snapshot.success), labels)
+      out.add(DURATION, snapshot.duration, labels)
+
+def jobs(targets, modules, scraper):
+  """ Return polling jobs for all 'modules' of all 'targets' supported by 'scraper' """
+  result = {}
+  for target in targets:
+    for module in modules:
+      try:
+        result[(target, module)] = scraper(target, module)
+      except HTTPError:
+        continue
+
+  return result
@@ -0,0 +1,123 @@
+"""
+Record and replay of device API responses
+
+In record mode every request sent by an exporter's request() method is
+stored with its response (or exception) and timing in a JSON lines archive,
+gzip compressed if the file name ends in .gz. A new recording replaces an
+existing archive. In replay mode the exporter is served from such an
+archive without any network access: the responses of each (target, endpoint,
+request body) are returned in recorded order, starting over when exhausted,
+after their recorded latency divided by 'speed' (0 answers immediately).
+Passwords in query strings and request bodies, cookies and authorization
+headers are never written to the archive.
+"""
+
+import base64
+import gzip
+import json
+import re
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+PASSWORD = re.compile(r"(password=)[^&]*")
+# Headers carrying session credentials, compared in lower case
+CREDENTIALS = {"set-cookie", "cookie", "authorization"}
+
+def archive(path, mode):
+  """ Open archive 'path', gzip compressed if its name ends in .gz """
+  if path.endswith(".gz"):
+    return gzip.open(path, mode, encoding="utf-8")
+  return open(path, mode, encoding="utf-8")
+
+def key(target, endpoint, post):
+  """ Return the lookup key of a request, credentials removed """
+  if isinstance(post, dict) and 'password' in post:
+    post = {**post, 'password': "***"}
+  return json.dumps([target, PASSWORD.sub(r"\1***", endpoint), post], sort_keys=True)
+
+def encode(response):
+  """ Return the archived form of 'response' """
+  headers = {name: value for (name, value) in response.headers.items() if name.lower() not in CREDENTIALS}
+  entry = {'status': response.status_code, 'reason': response.reason, 'headers': headers}
+  try:
+    entry['text'] = response.content.decode('utf-8')
+  except UnicodeDecodeError:
+    entry['b64'] = base64.b64encode(response.content).decode('ascii')
+  return entry
+
+def decode(entry, url):
+  """ Return a response object rebuilt from archived 'entry' """
+  response = requests.Response()
+  response.status_code = entry['status']
+  response.reason = entry.get('reason')
+  response.headers = CaseInsensitiveDict(entry.get('headers') or {})
+  response._content = entry['text'].encode('utf-8') if 'text' in entry else base64.b64decode(entry['b64']) # pylint: disable=protected-access
+  response.url = url
+  return response
+
+class Recorder():
+  """ Pass-through, recording or replaying transport of an exporter's requests """
+
+  def __init__(self, record=None, replay=None, speed=1):
+    self.lock = threading.Lock()
+    self.speed = speed
+    self.start = time.monotonic()
+    self.archive = archive(record, "wt") if record else None
+    self.recorded = None
+    if replay:
+      self.recorded = {}
+      with archive(replay, "rt") as f:
+        try:
+          for line in f:
+            entry = json.loads(line)
+            self.recorded.setdefault(entry['key'], []).append(entry)
+        except (EOFError, ValueError):
+          # The recording exporter was killed, entries up to then were flushed completely
+          pass
+      self.position = dict.fromkeys(self.recorded, 0)
+
+  def request(self, target, endpoint, send, post=None):
+    """ Return the response of send(), the request to 'endpoint' of 'target' """
+    if self.recorded is not None:
+      return self.replay(target, endpoint, post)
+    if self.archive is None:
+      return send()
+
+    start = time.monotonic()
+    entry = {'key': key(target, endpoint, post), 't': round(start - self.start, 3)}
+    try:
+      response = send()
+    except requests.exceptions.RequestException as e:
+      entry['error'] = type(e).__name__
+      entry['message'] = str(e)
+      raise
+    else:
+      entry.update(encode(response))
+      return response
+    finally:
+      entry['duration'] = round(time.monotonic() - start, 4)
+      line = json.dumps(entry, separators=(",", ":"))
+      with self.lock:
+        self.archive.write(line + "\n")
+        # Every entry is flushed, an exporter being stopped loses nothing
+        self.archive.flush()
+
+  def replay(self, target, endpoint, post):
+    """ Return (or raise) the next recorded response of the request """
+    k = key(target, endpoint, post)
+    with self.lock:
+      entries = self.recorded.get(k)
+      if not entries:
+        raise requests.exceptions.ConnectionError(f"No recorded response of {endpoint} on {target}")
+      entry = entries[self.position[k] % len(entries)]
+      self.position[k] += 1
+
+    if self.speed:
+      time.sleep(entry['duration'] / self.speed)
+    if 'error' in entry:
+      error = getattr(requests.exceptions, entry['error'], requests.exceptions.RequestException)
+      raise error(entry.get('message'))
+    return decode(entry, f"http://{target}/{endpoint.lstrip('/')}")
@@ -0,0 +1,37 @@
+"""
+Fixed-size ring buffer of float samples backed by an array
+
+Memory per buffer is constant (8 bytes per slot), independent of how long
+samples are collected.
+"""
+
+from array import array
+
+class Ring():
+  """ Ring buffer keeping the last 'size' samples """
+
+  __slots__ = ('values', 'size', 'written')
+
+  def __init__(self, size):
+    self.values = array('d', bytes(8 * size))
+    self.size = size
+    self.written = 0
+
+  def append(self, value):
+    """ Store a sample, overwriting the oldest one if the buffer is full """
+    self.values[self.written % self.size] = value
+    self.written += 1
+
+  def window(self, since):
+    """
+      Returning (min, max, mean, last, count) of all samples appended after
+      the first 'since' samples, limited to the samples still in the buffer.
+      Returns None if there is no such sample.
+    """
+    count = min(self.written - since, self.size)
+    if count <= 0:
+      return None
+
+    start = self.written - count
+    samples = [self.values[i % self.size] for i in range(start, self.written)]
+    return min(samples), max(samples), sum(samples) / count, samples[-1], count
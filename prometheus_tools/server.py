@@ -0,0 +1,250 @@
+"""
+Concurrent HTTP/1.1 serving core shared by all exporters
+
+Scrapes are handled by a bounded pool of worker threads, so a single slow
+or hanging device no longer blocks the scrapes of all other targets.
+Responses carry a Content-Length which allows Prometheus to keep the
+connection alive between scrapes. Idle keep-alive connections wait in a
+selector, a connection only occupies a worker while a request is answered.
+"""
+
+import queue
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import prometheus_client as prom
+
+from prometheus_tools import instrument
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+WORKERS = 16
+KEEPALIVE_TIMEOUT = 5
+
+ERROR_MESSAGE_FORMAT = """
+  <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
+    "http://www.w3.org/TR/html4/strict.dtd">
+  <html>
+    <head>
+      <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
+      <title>Error response</title>
+    </head>
+    <body>
+      <h1>Error response</h1>
+      <p>Error code: %(code)d</p>
+      <p>Traceback: <pre>%(message)s</pre></p>
+      <p>Error code explanation: %(code)s - %(explain)s.</p>
+    </body>
+  </html>
+"""
+
+class HTTPError(Exception):
+  """ Raised by exporters to answer a scrape with an HTTP error """
+
+  def __init__(self, code, message, explain=None):
+    super().__init__(message)
+    self.code = code
+    self.message = message
+    self.explain = explain
+
+class ExporterHandler(BaseHTTPRequestHandler):
+  """
+    HTTP/1.1 request handler for Prometheus multi-target exporters
+
+    Subclasses provide 'targets' (any container supporting 'in') and
+    implement collect(target, modules) returning exposition format bytes.
+    Additional paths are mapped to handler methods in 'routes', these are
+    called with the parsed query parameters. Subclasses extend 'routes', so
+    the exporter's own metrics stay available on /metrics. The modules an
+    exporter scrapes are registered in 'scrapers' by name.
+  """
+
+  protocol_version = "HTTP/1.1"
+  # Idle keep-alive connections are closed after this many seconds
+  timeout = KEEPALIVE_TIMEOUT
+  # Headers and body are written separately, Nagle would hold back the body for a delayed ACK
+  disable_nagle_algorithm = True
+  error_message_format = ERROR_MESSAGE_FORMAT
+
+  targets = {}
+  modules_required = True
+  routes = {'/metrics': 'metrics'}
+  scrapers = {}
+
+  # pylint: disable=invalid-name; Method provided by upstream class
+  def do_GET(self):
+    """ Provide data in Prometheus Exposition Format upon client request """
+    url = urlsplit(self.path)
+
+    # Avoid errors from browsers auto-requesting favicons
+    if url.path == '/favicon.ico':
+      self.reply(b"", 'image/x-icon')
+      return
+
+    query_params = parse_qs(url.query)
+    try:
+      metrics = self.dispatch(url.path, query_params)
+    except HTTPError as e:
+      self.send_error(e.code, message=e.message, explain=e.explain)
+      return
+    except Exception as e: # pylint: disable=broad-exception-caught
+      # Report any failure of a scrape to Prometheus instead of dropping the connection
+      self.log_error("Scrape of %s failed: %r", self.path, e)
+      self.send_error(500, message=type(e).__name__, explain=str(e))
+      return
+
+    self.reply(metrics)
+
+  def handle(self):
+    """ Answer the requests received on the connection, the server waits for further requests """
+    self.close_connection = True
+    self.handle_one_request()
+    while not self.close_connection and self.pending():
+      self.handle_one_request()
+
+  def pending(self):
+    """ Return True if the next request has been received already (pipelining) """
+    self.connection.setblocking(False)
+    try:
+      return bool(self.rfile.peek(1))
+    except OSError:
+      return False
+    finally:
+      self.connection.settimeout(self.timeout)
+
+  def dispatch(self, path, query_params):
+    """ Answer a request of 'path' by its method in 'routes', any other path is a probe """
+    return getattr(self, self.routes.get(path, 'probe'))(query_params)
+
+  @classmethod
+  def modules(cls):
+    """ Return the names of all modules the exporter scrapes """
+    return list(cls.scrapers)
+
+  def probe(self, query_params):
+    """ Answer a probe of a single target '?target=<target>&module=<module>' """
+    if "target" not in query_params:
+      raise HTTPError(404, message="No target!", explain="No target specified in query ...")
+    target = query_params['target'][0]
+
+    if target not in self.targets:
+      raise HTTPError(404, message="Target does not exist!", explain=f"Target {target} not configured ...")
+
+    # Prometheus is quering multiple modules in one request -> multiple 'module' params possible
+    modules = query_params.get('module')
+    if modules is None and self.modules_required:
+      raise HTTPError(404, message="No module!", explain="No module specified in query ...")
+
+    with instrument.scrape(target, modules):
+      return self.collect(target, modules)
+
+  def metrics(self, query_params): # pylint: disable=unused-argument
+    """ Answer a scrape of the exporter's own metrics, process metrics are added with --self-metrics """
+    return instrument.render() + prom.generate_latest(prom.REGISTRY)
+
+  def collect(self, target, modules):
+    """ Return metrics in Prometheus Exposition Format for all requested modules, 404 without probes """
+    raise HTTPError(404, message="No probes!", explain=f"This exporter cannot probe {target} ...")
+
+  def reply(self, body, content_type=CONTENT_TYPE):
+    """ Send a complete response with Content-Length to keep the connection alive """
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+class PooledHTTPServer(HTTPServer):
+  """
+    HTTP server dispatching requests to a bounded pool of worker threads
+    Connections wait in a selector until a request arrives, so idle keep-alive
+    connections of Prometheus do not occupy workers between scrapes.
+  """
+
+  allow_reuse_address = True
+  request_queue_size = 64
+
+  def __init__(self, address, handler, workers=WORKERS):
+    super().__init__(address, handler)
+    self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scrape")
+    self.keepalive = handler.timeout or KEEPALIVE_TIMEOUT
+    self.selector = selectors.DefaultSelector()
+    # Connections are registered by the selector thread only, others hand them over and wake it up
+    self.waiting = queue.SimpleQueue()
+    self.wakeup = socket.socketpair()
+    self.selector.register(self.wakeup[0], selectors.EVENT_READ)
+    self.closing = False
+    threading.Thread(target=self.watch, name="keepalive", daemon=True).start()
+
+  def process_request(self, request, client_address):
+    """ Wait for the first request of a new connection """
+    self.idle(request, client_address)
+
+  def idle(self, request, client_address):
+    """ Hand the connection over to the selector until its next request """
+    self.waiting.put((request, client_address))
+    self.wakeup[1].send(b"\0")
+
+  def watch(self):
+    """ Submit connections with a request to the pool, close those idle beyond the keep-alive timeout """
+    while not self.closing:
+      for (key, _) in self.selector.select(timeout=1):
+        if key.fileobj is self.wakeup[0]:
+          self.wakeup[0].recv(4096)
+          while not self.waiting.empty():
+            (request, client_address) = self.waiting.get()
+            self.selector.register(request, selectors.EVENT_READ, (client_address, time.monotonic() + self.keepalive))
+          continue
+        self.selector.unregister(key.fileobj)
+        self.pool.submit(self.process_request_thread, key.fileobj, key.data[0])
+
+      now = time.monotonic()
+      for key in list(self.selector.get_map().values()):
+        if key.data and key.data[1] < now:
+          self.selector.unregister(key.fileobj)
+          self.shutdown_request(key.fileobj)
+
+    for key in list(self.selector.get_map().values()):
+      if key.data:
+        self.shutdown_request(key.fileobj)
+    self.selector.close()
+
+  def process_request_thread(self, request, client_address):
+    """ Answer the pending request(s) of a connection within a worker """
+    try:
+      handler = self.RequestHandlerClass(request, client_address, self)
+    except Exception: # pylint: disable=broad-exception-caught
+      self.handle_error(request, client_address)
+      self.shutdown_request(request)
+      return
+
+    if handler.close_connection:
+      self.shutdown_request(request)
+    else:
+      self.idle(request, client_address)
+
+  def server_close(self):
+    super().server_close()
+    self.closing = True
+    self.wakeup[1].send(b"\0")
+    self.pool.shutdown(wait=False, cancel_futures=True)
+
+def self_metrics(enabled):
+  """ Serve process metrics on /metrics only if 'enabled' (--self-metrics) """
+  if not enabled:
+    prom.REGISTRY.unregister(prom.PROCESS_COLLECTOR)
+    prom.REGISTRY.unregister(prom.PLATFORM_COLLECTOR)
+    prom.REGISTRY.unregister(prom.GC_COLLECTOR)
+
+def serve(listen, handler, workers=WORKERS):
+  """ Run the exporter on 'address:port' until interrupted """
+  address, port = listen.split(":")
+  server = PooledHTTPServer((address, int(port)), handler, workers)
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
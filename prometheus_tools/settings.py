@@ -0,0 +1,37 @@
+"""
+Config loader shared by all exporters
+
+Exporter configs are YAML files, or mappings inlined in the config of the
+multi-exporter host. Sections are available as items and as attributes, so
+'getattr(config, <section>, None)' selects optional sections.
+"""
+
+import sys
+import traceback
+
+import yaml
+from yaml.loader import SafeLoader
+
+class Config(dict):
+  """ Exporter config, sections are items and attributes """
+
+  def __getattr__(self, key):
+    try:
+      return self[key]
+    except KeyError as e:
+      raise AttributeError(key) from e
+
+def load(source):
+  """ Return the Config of YAML file 'source' or of an inline mapping """
+  if isinstance(source, dict):
+    return Config(source)
+
+  try:
+    f = open(source, encoding="utf-8")
+  except OSError:
+    print("Could not open/read file: " + source)
+    print(traceback.format_exc().strip())
+    sys.exit(1)
+
+  with f:
+    return Config(yaml.load(f, Loader=SafeLoader) or {})
@@ -0,0 +1,30 @@
+"""
+HTTP connection pool shared by all exporters of a process
+
+Device and provider requests reuse keep-alive connections from a single
+pool instead of opening a new connection per request. Exporters keeping
+cookies (e.g. authenticated Keenetic sessions) use their own session on
+the same pool.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Hosts with pooled connections, connections kept per host
+HOSTS = 64
+CONNECTIONS = 16
+
+ADAPTER = HTTPAdapter(pool_connections=HOSTS, pool_maxsize=CONNECTIONS)
+
+def session():
+  """ Return a new session with its own cookies on the shared connection pool """
+  result = requests.Session()
+  result.mount("http://", ADAPTER)
+  result.mount("https://", ADAPTER)
+  return result
+
+SESSION = session()
+
+def get(url, **kwargs):
+  """ Send a GET request on the shared connection pool """
+  return SESSION.get(url, **kwargs)
@@ -5,8 +5,8 @@
 Dependencies:
   apt install python3-prometheus-client
   apt install python3-requests
-  apt install python3-uritools
   apt install python3-yaml
+  prometheus_tools (shared exporter core, found next to this script's directory)
 
 Config file format:
 
@@ -21,26 +21,38 @@ endpoints:
 """
 
 # Standard imports
+import ipaddress
+import json
 import os
+import subprocess
+import threading
 import time
-import traceback
 from string import Template
 import sys
 import syslog
 
 # Additional imports
 import argparse
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import prometheus_client as prom
-from prometheus_client import Metric, CollectorRegistry, generate_latest
-import requests
-from uritools import urisplit
-import yaml
-from yaml.loader import SafeLoader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+# pylint: disable=wrong-import-position
+from prometheus_tools import exposition, fanout, instrument, server, settings, transport
 
 PROGRAMNAME = os.path.basename(sys.argv[0])
 CONFIGFILE = os.path.splitext(PROGRAMNAME)[0] + ".conf"
 LISTEN = ":8000"
+STATEFILE = os.path.splitext(PROGRAMNAME)[0] + ".state"
+TTL = 3600
+RETRY = 60
+TIMEOUT = 10
+HEDGE = 1
+DEADLINE = 30
+QUOTA_BACKOFF = 3600
+
+REFRESH_AGE = exposition.family("public_ip_refresh_age_seconds", "Seconds since the public IP data was refreshed", "gauge")
+LATENCY = exposition.family("public_ip_provider_latency_seconds", "Latency of public IP lookups", "histogram")
+EXHAUSTED = exposition.family("public_ip_provider_quota_exhausted", "Provider rejected lookups for exceeding its quota", "gauge")
+REMAINING = exposition.family("public_ip_provider_quota_remaining", "Lookups left as reported by the provider", "gauge")
 
 # Module argparse
 def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=60)
@@ -53,7 +65,7 @@ cli = argparse.ArgumentParser(
 cli.add_argument('-c', '--config-file', action='store', default=CONFIGFILE, help="location of the config file")
 cli.add_argument('-l', '--listen', action='store', default=LISTEN, help="server address and port")
 cli.add_argument('--self-metrics', action=argparse.BooleanOptionalAction, help="enable process metrics")
-args = cli.parse_args()
+cli.add_argument('-w', '--workers', action='store', type=int, default=server.WORKERS, help="concurrent scrapes")
 
 # Module syslog
 syslog.openlog(logoption=syslog.LOG_PID)
@@ -62,86 +74,212 @@ def log(message): syslog.syslog(syslog.LOG_INFO,message)
 # Module time
 def now(): return int(time.time())
 
-class Config():
+class State():
+  """ Public IP data of a single target """
+
+  def __init__(self, ipinfo=None, first_seen=None, timestamp=0):
+    self.ipinfo = ipinfo
+    self.first_seen = first_seen
+    self.timestamp = timestamp
 
-  def __init__(self, configfile):
-    with open(configfile, encoding="utf-8") as f:
-      config = yaml.load(f, Loader=SafeLoader)
-    self.__dict__ = config
+class Provider():
+  """
+    Source of the public IP address: 'json' (ipinfo style API), 'text' (plain
+    echo service) or 'command' (local command, e.g. querying the router)
+  """
 
-class Collector():
+  def __init__(self, name, config):
+    self.name = name
+    self.type = config.get('type', 'json')
+    self.url = Template(config['url']).substitute(token=config.get('token', "")) if 'url' in config else None
+    self.command = config.get('command')
+    self.field = config.get('field')
+    self.timeout = config.get('timeout', TIMEOUT)
+    self.latency = exposition.Histogram()
+    self.exhausted_until = 0
+    self.remaining = None
 
-  def collect(self):
-    return metrics.values()
+  def available(self):
+    """ Return False while the provider's quota is exceeded """
+    return now() >= self.exhausted_until
+
+  def lookup(self):
+    """ Return the IP data dict, raises on failures and invalid addresses """
+    start = time.monotonic()
+    try:
+      if self.type == 'command':
+        output = instrument.request(self.name, subprocess.run, self.command,
+          capture_output=True, text=True, timeout=self.timeout, check=True).stdout
+      else:
+        r = instrument.request(self.name, transport.get, self.url, timeout=self.timeout)
+        self.quota(r)
+        r.raise_for_status()
+        output = r.content.decode('utf-8', errors='replace')
+    finally:
+      self.latency.observe(time.monotonic() - start)
 
-class Handler(BaseHTTPRequestHandler):
+    if self.type == 'json':
+      ipinfo = instrument.decode(self.name, output)
+    elif self.field:
+      ipinfo = {'ip': instrument.decode(self.name, output)[self.field]}
+    else:
+      ipinfo = {'ip': output.strip()}
+    # Rejects error pages and empty answers
+    ipaddress.ip_address(ipinfo['ip'])
+    return ipinfo
 
-  config = Config(args.config_file)
+  def quota(self, r):
+    """ Track the quota state reported in response 'r' """
+    remaining = r.headers.get('X-RateLimit-Remaining')
+    if remaining is not None and remaining.isdigit():
+      self.remaining = int(remaining)
+    if r.status_code == 429:
+      retry = r.headers.get('Retry-After', "")
+      self.exhausted_until = now() + (int(retry) if retry.isdigit() else QUOTA_BACKOFF)
 
-  def do_GET(self):
-    url = urisplit(self.path)
+  def expose(self, out):
+    """ Add latency and quota metrics to exposition 'out' """
+    labels = {'provider': self.name}
+    self.latency.expose(out, LATENCY, labels)
+    out.add(EXHAUSTED, int(not self.available()), labels)
+    if self.remaining is not None:
+      out.add(REMAINING, self.remaining, labels)
 
-    self.error_message_format = """
-      <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
-        "http://www.w3.org/TR/html4/strict.dtd">
-      <html>
-        <head>
-          <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
-          <title>Error response</title>
-        </head>
-        <body>
-          <h1>Error response</h1>
-          <p>Error code: %(code)d</p>
-          <p>Traceback: <pre>%(message)s</pre></p>
-          <p>Error code explanation: %(code)s - %(explain)s.</p>
-        </body>
-      </html>
-    """
+class Store():
+  """
+    Per-target public IP state, refreshed in the background on each target's
+    TTL and persisted atomically, so a restart keeps the age of the address
+  """
 
+  def __init__(self, config):
+    self.targets = config.target
+    state = getattr(config, 'state', None) or {}
+    self.path = state.get('file', STATEFILE)
+    self.ttl = state.get('ttl', TTL)
+    self.retry = state.get('retry', RETRY)
+    self.lock = threading.Lock()
+    self.states = {target: State() for target in self.targets}
+    self.providers = {name: Provider(name, provider) for (name, provider) in (getattr(config, 'providers', None) or {}).items()}
+    for (target, section) in self.targets.items():
+      if 'url' in section:
+        # A target with its own URL is its single provider
+        self.providers[target] = Provider(target, section)
+    self.pool = fanout.executor(name="lookup")
+    self.load()
+
+  def load(self):
+    """ Restore the states saved by a previous run """
     try:
-      target = url.getquerydict().get('target')[0]
-    except KeyError:
-      trace = traceback.format_exc().strip()
-      self.send_error(404, message=trace, explain="No target specified in query ...")
+      with open(self.path, encoding="utf-8") as f:
+        saved = json.load(f)
+    except FileNotFoundError:
+      return
+    except ValueError as e:
+      log(f"Ignoring unreadable state file {self.path}: {e}")
       return
+    for (target, state) in saved.items():
+      if target in self.states:
+        self.states[target] = State(**state)
+
+  def save(self):
+    """ Write all states to disk, replacing the previous file atomically """
+    with self.lock:
+      saved = {target: vars(state) for (target, state) in self.states.items()}
+    with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+      json.dump(saved, f)
+    os.replace(self.path + ".tmp", self.path)
+
+  def period(self, target):
+    """ Return the refresh interval of 'target' """
+    return self.targets[target].get('ttl', self.ttl)
 
-    if (now() - data["timestamp"]) > 3600 or data.get("first_seen") is None:
-      # Config is dynamically loaded from config file
-      # pylint: disable=no-member
-      url = Template(self.config.target[target]["url"]).substitute(token=self.config.target[target]["token"])
-      log(f"Cached public IP address data expired - updating from {url}")
-      r = requests.get(url, timeout=30)
-      if r.status_code != 200:
-        self.send_error(503, message=f"Backend API returned {r.status_code}", explain="Backend query failed.")
-      data["ipinfo"] = r.json()
-
-      if data["ipinfo"]["ip"] != r.json()["ip"]:
+  def start(self):
+    """ Start refreshing all targets in a background thread """
+    threading.Thread(target=self.schedule, name="refresh", daemon=True).start()
+
+  def schedule(self):
+    """ Refresh each target once its data is older than its TTL """
+    due = {target: state.timestamp + self.period(target) for (target, state) in self.states.items()}
+    while True:
+      target = min(due, key=due.get)
+      time.sleep(max(due[target] - now(), 0))
+      try:
+        self.refresh(target)
+        due[target] = now() + self.period(target)
+      except Exception as e: # pylint: disable=broad-exception-caught
+        # Any failure, e.g. an unwritable state file, must not end the refreshes of all targets
+        log(f"Refreshing public IP address data from {target} failed: {e!r}")
+        due[target] = now() + self.retry
+
+  def chain(self, target):
+    """ Return the providers of 'target' in order of preference """
+    section = self.targets[target]
+    names = section.get('providers') or ([target] if 'url' in section else [])
+    return [self.providers[name] for name in names]
+
+  def refresh(self, target):
+    """ Query the providers of 'target' hedged and update its state """
+    section = self.targets[target]
+    providers = [provider for provider in self.chain(target) if provider.available()]
+    log(f"Cached public IP address data expired - updating from {', '.join(p.name for p in providers)}")
+    winner, failures = fanout.hedge(self.pool, [(p.name, p.lookup) for p in providers],
+      section.get('hedge', HEDGE), section.get('deadline', DEADLINE))
+    for (name, e) in failures.items():
+      log(f"Public IP lookup from {name} failed: {e!r}")
+    if winner is None:
+      raise LookupError(f"No provider of {target} answered")
+    ipinfo = winner[1]
+
+    with self.lock:
+      state = self.states[target]
+      if state.ipinfo is None or state.ipinfo["ip"] != ipinfo["ip"]:
         # On newly assigned IP
-        data["first_seen"] = now()
+        state.first_seen = now()
+      else:
+        # Plain answers keep the details of a previous richer answer
+        ipinfo = {**state.ipinfo, **ipinfo}
+      state.ipinfo = ipinfo
+      state.timestamp = now()
+    self.save()
 
-    if data.get("first_seen") is None:
-      data["first_seen"] = now()
-    data["age"] = now() - data["first_seen"]
-    data["timestamp"] = now()
+  def render(self, target):
+    """ Render the state of 'target' from memory """
+    with self.lock:
+      state = self.states[target]
+      if state.ipinfo is None:
+        raise server.HTTPError(503, message="No data!", explain=f"Public IP not retrieved from {target} yet.")
+      out = exposition.Exposition()
+      family = exposition.family("public_ip", f"Public IP provided by {target}")
+      out.add(family, now() - state.first_seen, state.ipinfo)
+      out.add(REFRESH_AGE, now() - state.timestamp)
+    for provider in self.chain(target):
+      provider.expose(out)
 
-    metrics["public_ip"] = Metric("public_ip", f"Public IP provided by {target}", "untyped")
-    metrics["public_ip"].add_sample("public_ip", value=data["age"], labels=data["ipinfo"])
+    return out.render()
 
-    self.send_response(200)
-    self.end_headers()
-    self.wfile.write(generate_latest(registry))
+class Handler(server.ExporterHandler):
+
+  config = None
+  modules_required = False
+  store = None
+
+  def collect(self, target, modules):
+    # Scrapes never wait for a backend, the store is refreshed in the background
+    return self.store.render(target)
+
+def plugin(options, config): # pylint: disable=unused-argument
+  """ Set up the exporter with 'config' and the command line 'options', returns its handler """
+  Handler.config = config
+  Handler.targets = config.target
+  Handler.store = Store(config)
+  Handler.store.start()
+  return Handler
 
 if __name__ == '__main__':
-  data = { "timestamp": now() }
-  metrics = {}
-  registry = CollectorRegistry()
-  registry.register(Collector())
-  if args.self_metrics:
-    registry.register(prom.PROCESS_COLLECTOR)
-    registry.register(prom.PLATFORM_COLLECTOR)
-    registry.register(prom.GC_COLLECTOR)
-
-  address, port = args.listen.split(":")
-  log(f"Starting {PROGRAMNAME} on {address}:{port} ...")
-  server = HTTPServer((address, int(port)), Handler)
-  server.serve_forever()
+  args = cli.parse_args()
+  # Process metrics are served on /metrics with --self-metrics
+  server.self_metrics(args.self_metrics)
+  handler = plugin(args, settings.load(args.config_file))
+
+  log(f"Starting {PROGRAMNAME} on {args.listen} ...")
+  server.serve(args.listen, handler, args.workers)
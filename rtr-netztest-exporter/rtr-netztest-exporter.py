@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# Dependencies:
+#  apt install python3-prometheus-client
+#  apt install python3-yaml
+#  prometheus_tools (shared exporter core, found next to this script's directory)
+
+"""
+Prometheus exporter serving daily percentiles and quality counts of the
+RTR-Netztest results history recorded by rtr-netztest.py
+
+Scrape http://<listen>/percentiles
+"""
+
+import os
+import sys
+import syslog
+
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+# pylint: disable=wrong-import-position
+from prometheus_tools import exposition, history, server, settings
+
+PROGRAMNAME = os.path.basename(sys.argv[0])
+# Shared with rtr-netztest.py
+CONFIGFILE = "rtr-netztest.conf"
+LISTEN = ":8000"
+
+# Module argparse
+def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=60)
+cli = argparse.ArgumentParser(
+  prog = PROGRAMNAME,
+  description = "Prometheus exporter for the RTR-Netztest results history.",
+  epilog = "",
+  formatter_class=formatter
+)
+cli.add_argument('-c', '--config-file', action='store', default=CONFIGFILE, help="location of the config file")
+cli.add_argument('-l', '--listen', action='store', default=LISTEN, help="server address and port")
+cli.add_argument('-w', '--workers', action='store', type=int, default=server.WORKERS, help="concurrent scrapes")
+args = cli.parse_args()
+
+# Module syslog
+syslog.openlog(logoption=syslog.LOG_PID)
+def log(message): syslog.syslog(syslog.LOG_INFO,message)
+
+class Handler(server.ExporterHandler):
+
+  config = settings.load(args.config_file)
+  store = history.History(config.history['database'])
+  days = config.history.get('days', history.DAYS)
+  routes = {**server.ExporterHandler.routes, '/percentiles': 'percentiles'}
+
+  def percentiles(self, query_params): # pylint: disable=unused-argument
+    """ Answer a scrape of the precomputed daily statistics """
+    out = exposition.Exposition()
+    self.store.expose(out, self.days)
+    return out.render()
+
+if __name__ == '__main__':
+  log(f"Starting {PROGRAMNAME} on {args.listen} ...")
+  server.serve(args.listen, Handler, args.workers)
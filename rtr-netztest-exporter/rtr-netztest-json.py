@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
+import argparse
+import importlib.util
 import json
+import os
+import sys
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
@@ -10,41 +14,38 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from webdriver_manager.chrome import ChromeDriverManager
 
+DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(DIRECTORY, os.pardir))
+# pylint: disable=wrong-import-position
+from prometheus_tools import settings
+
+# Result retrieval is shared with the test runner
+spec = importlib.util.spec_from_file_location("netztest", os.path.join(DIRECTORY, "rtr-netztest.py"))
+netztest = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(netztest)
+
+cli = argparse.ArgumentParser(description="Run RTR-Netztest and print the results as JSON.")
+cli.add_argument('-c', '--config-file', action='store', default=os.path.join(DIRECTORY, "rtr-netztest.conf"),
+  help="location of the config file")
+cli.add_argument('--control-server', action='store', help="RMBT control server base URL, overrides the config")
+args = cli.parse_args()
+config = settings.load(args.config_file)
+control_server = args.control_server or config.get('control_server', netztest.CONTROL_SERVER)
 
 options = Options()
 options.add_argument("--headless=new")
 driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
 driver.set_window_position(2000, 50)
 
-driver.get("https://www.netztest.at/de/Test")
-wait = WebDriverWait(driver, 120)
-element = wait.until(EC.presence_of_element_located((By.ID, 'modal-confirm')))
-element.click()
-wait.until(EC.presence_of_element_located((By.ID, 'verlauf-detail')))
-WebDriverWait(driver, 10).until(EC.text_to_be_present_in_element((By.TAG_NAME, "td"), "Download"))
-
-#print(driver.get_cookies())
-#cookies = driver.get_cookies()
-#driver.get("https://c01.netztest.at/RMBTControlServer/testresultdetail")
-#for cookie in cookies:
-#  driver.add_cookie(cookie)
-#print(driver.page_source)
-
-data = {}
-
-table = driver.find_element(By.ID, "verlauf-detail")
-rows = table.find_elements(By.TAG_NAME, "tr")
-for row in rows:
-   key, value = row.find_elements(By.TAG_NAME, "td")
-   data[key.text] = value.text
-
-table = driver.find_element(By.ID, "testresult-detail")
-rows = table.find_elements(By.TAG_NAME, "tr")
-for row in rows:
-   key, value = row.find_elements(By.TAG_NAME, "td")
-   data[key.text] = value.text
-
-json = json.dumps(data)
-print(json)
-
-driver.quit()
+try:
+  driver.get(netztest.TEST_URL)
+  wait = WebDriverWait(driver, 120)
+  element = wait.until(EC.presence_of_element_located((By.ID, 'modal-confirm')))
+  element.click()
+  wait.until(EC.presence_of_element_located((By.ID, 'verlauf-detail')))
+  WebDriverWait(driver, 10).until(EC.text_to_be_present_in_element((By.TAG_NAME, "td"), "Download"))
+
+  uuid = WebDriverWait(driver, 10).until(netztest.test_uuid, "No test UUID in the result page URL")
+  print(json.dumps(netztest.fetch(uuid, control_server)))
+finally:
+  driver.quit()
@@ -1,30 +1,56 @@
 #!/usr/bin/env python3
 
+import argparse
 import os
+import random
+import re
 import sys
 import syslog
+import time
 
 from datetime import datetime
-import math
+from urllib.parse import urlsplit
 import pprint
 from pyvirtualdisplay import Display
 import requests
 
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+# pylint: disable=wrong-import-position
+from prometheus_tools import settings
+from prometheus_tools.evidence import Evidence
+from prometheus_tools.history import History, quality
+
+PROGRAMNAME = os.path.basename(sys.argv[0])
+CONFIGFILE = os.path.splitext(PROGRAMNAME)[0] + ".conf"
+INTERVAL = 3600
+JITTER = 300
+CONTROL_SERVER = "https://c01.netztest.at/RMBTControlServer"
+
+# module argparse
+def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=60)
+cli = argparse.ArgumentParser(
+  prog = PROGRAMNAME,
+  description = "Run RTR-Netztest and push the results to Victoriametrics.",
+  epilog = "",
+  formatter_class=formatter
+)
+cli.add_argument('-c', '--config-file', action='store', default=CONFIGFILE, help="location of the config file")
+cli.add_argument('-d', '--daemon', action=argparse.BooleanOptionalAction, help="keep the browser running between tests")
+cli.add_argument('-i', '--interval', action='store', type=int, default=INTERVAL, help="seconds between tests in daemon mode")
+cli.add_argument('-j', '--jitter', action='store', type=int, default=JITTER, help="random deviation from the interval")
+cli.add_argument('--control-server', action='store', help="RMBT control server base URL, overrides the config")
 
 # module pprint
 pp = pprint.PrettyPrinter(indent=2)
 
-# module pyvirtualdisplay
-display = Display(visible=0, size=(1300, 2675))
-display.start()
-
 # module selenium
 options = Options()
 # Enable options below to run as root
@@ -33,113 +59,294 @@ options = Options()
 #options.add_argument("--no-sandbox")
 options.add_argument("--hide-scrollbars")
 options.BinaryLocation = "/usr/bin/chromium-browser"
-driver = webdriver.Chrome(options=options, service=Service("/usr/bin/chromedriver"))
 
 # module syslog
 syslog.openlog(logoption=syslog.LOG_PID)
 log = syslog.syslog
-log("Starting test run ...")
-
-DATE = str(datetime.now().date())
-EVIDENCE_DIR = "/var/www/html/evidence/" + DATE
-INF = math.inf
-
-# pylint: disable=consider-using-namedtuple-or-dataclass
-# Will be moved to a config file
-t = {
-  'download': {
-    'bad': { 'lower': 0, 'upper': 9 },
-    'average': { 'lower': 10, 'upper': 19 },
-    'good': { 'lower': 20, 'upper': INF }
-  },
-  'upload': {
-    'bad': { 'lower': 0, 'upper': 4 },
-    'average': { 'lower': 5, 'upper': 9 },
-    'good': { 'lower': 10, 'upper': INF }
-  },
-  'ping': {
-    'bad': { 'lower': 50, 'upper': INF },
-    'average': { 'lower': 20, 'upper': 49 },
-    'good': { 'lower': 0, 'upper': 19 }
-  }
-}
+
+IMPORT_URL = "http://localhost:8428/api/v1/import/prometheus"
+SPOOL_DIR = "/var/spool/rtr-netztest"
+# Used if SPOOL_DIR is not writable, e.g. when run manually by a user
+SPOOL_FALLBACK = os.path.join(os.path.expanduser("~"), ".cache", "rtr-netztest")
+# Batches rejected by Victoriametrics are kept for inspection below the spool directory
+REJECTED = "rejected"
+TEST_URL = "https://www.netztest.at/de/Test"
+# The result page of a test carries its UUID as query, e.g. '.../Verlauf?<uuid>' or '...?uuid=<uuid>'
+UUID = re.compile(r"(?:^|[=&])([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?:&|$)")
 
 numeric_fields = ['Download', 'Upload', 'Ping']
 
-try:
-  driver.get("https://www.netztest.at/de/Test")
+def test_uuid(driver):
+  """ Return the UUID of the finished test from the query of the result page, False until it is shown """
+  # Only the location of the result page belongs to this test, the page source holds other UUIDs, e.g. of the client
+  match = UUID.search(urlsplit(driver.current_url).query)
+  return match.group(1) if match else False
+
+def number(value):
+  """ Return a numeric result value, e.g. '95,3 Mbit/s' as 95.3 """
+  if isinstance(value, (int, float)):
+    return float(value)
+  return float(str(value).split()[0].replace(",", "."))
+
+def fetch(uuid, control_server=CONTROL_SERVER):
+  """ Return the typed result fields of test 'uuid' retrieved from 'control_server' """
+  r = requests.post(f"{control_server}/testresultdetail", timeout=10,
+    json={'test_uuid': uuid, 'language': "de", 'timezone': "Europe/Vienna"})
+  r.raise_for_status()
+  data = r.json()
+  if data.get('error'):
+    raise ValueError("Control server error: " + "; ".join(data['error']))
+
+  results = {'uuid': uuid}
+  for item in data.get('testresultdetail', []):
+    key = item.get('title')
+    if key in numeric_fields:
+      results[key] = number(item['value'])
+    elif key:
+      results[key] = str(item.get('value', ""))
+
+  missing = [key for key in numeric_fields + ["Externe IP", "Betreiber"] if key not in results]
+  if missing:
+    raise ValueError("Missing result fields: " + ", ".join(missing))
+  return results
+
+def send(pef):
+  """ Import PEF lines into Victoriametrics, returns the HTTP status or None without an answer """
+  start = time.monotonic()
+  try:
+    r = requests.post(IMPORT_URL, data=pef, timeout=5)
+  except requests.exceptions.RequestException as e:
+    log("Victoriametrics API request failed: " + str(e))
+    return None
+  log(f"Victoriametrics API response: {r.status_code} after {time.monotonic() - start:.3f}s")
+  return r.status_code
+
+def retry(status):
+  """ Return True if a batch answered with 'status' is sent again later, other errors are permanent """
+  return status is None or status >= 500 or status in {408, 429}
+
+def spool(pef, directory=""):
+  """ Store a batch on disk ('directory' below the spool), returns False if no spool is writable """
+  name = f"{time.time_ns()}.prom"
+  for spooldir in (SPOOL_DIR, SPOOL_FALLBACK):
+    path = os.path.join(spooldir, directory, name)
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # Written under a temporary name, a crash never leaves a partial batch behind
+      with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(pef)
+      os.replace(path + ".tmp", path)
+      return True
+    except OSError as e:
+      log(f"Spooling to {spooldir} failed: {e}")
+
+  # Last resort, the batch is kept in the log
+  log("Batch could not be spooled: " + pef)
+  return False
+
+def spooled():
+  """ Return the paths of all spooled batches, oldest first """
+  paths = []
+  for spooldir in (SPOOL_DIR, SPOOL_FALLBACK):
+    if os.path.isdir(spooldir):
+      paths += [os.path.join(spooldir, f) for f in os.listdir(spooldir) if f.endswith(".prom")]
+  return sorted(paths, key=os.path.basename)
+
+def reject(path):
+  """ Move the spooled batch 'path' rejected by Victoriametrics out of the spool """
+  target = os.path.join(os.path.dirname(path), REJECTED, os.path.basename(path))
+  log(f"Victoriametrics rejected spooled batch, moving it to {target}")
+  try:
+    os.renames(path, target)
+  except OSError as e:
+    # A rejected batch must never block the spool
+    log(f"Moving {path} failed, removing it: {e}")
+    os.remove(path)
+
+def push(lines):
+  """ Replay spooled batches oldest first, then send the batch 'lines' """
+  pending = spooled()
+  while pending:
+    with open(pending[0], encoding="utf-8") as f:
+      status = send(f.read())
+    if retry(status):
+      break
+    if status >= 400:
+      reject(pending[0])
+    else:
+      os.remove(pending[0])
+    pending.pop(0)
+
+  if lines:
+    pef = "\n".join(lines) + "\n"
+    log("Sending Prometheus Exposition Format data to Victoriametrics: " + pef)
+    # Keep the order of results, spool if older batches are still pending
+    status = None if pending else send(pef)
+    if retry(status):
+      if spool(pef):
+        pending.append(pef)
+    elif status >= 400:
+      log(f"Victoriametrics rejected batch, keeping it in {REJECTED}")
+      spool(pef, REJECTED)
+  log(f"Victoriametrics spool depth: {len(pending)} batches")
+
+class Browser():
+  """ Virtual display with a chromium session, kept warm between tests """
+
+  def __init__(self):
+    self.display = None
+    self.driver = None
+    self.startup = None
+
+  def start(self):
+    """ Start display and browser, recording the startup time """
+    start = time.monotonic()
+    self.display = Display(visible=0, size=(1300, 2675))
+    self.display.start()
+    self.driver = webdriver.Chrome(options=options, service=Service("/usr/bin/chromedriver"))
+    self.startup = time.monotonic() - start
+
+  def stop(self):
+    """ Tear down browser and display, ignoring a crashed browser """
+    if self.driver is not None:
+      try:
+        self.driver.quit()
+      except WebDriverException:
+        pass
+      self.driver = None
+    if self.display is not None:
+      self.display.stop()
+      self.display = None
+
+  def session(self):
+    """ Return a working driver, restarting the browser after a crash """
+    if self.driver is not None:
+      try:
+        _ = self.driver.current_url
+      except WebDriverException as e:
+        log("Browser session lost, restarting: " + str(e))
+        self.stop()
+    if self.driver is None:
+      self.start()
+    return self.driver
+
+def run(browser, control_server):
+  """ Run a single test, returns the result table, the phase timings and a screenshot """
+  timings = {}
+  driver = browser.session()
+  if browser.startup is not None:
+    # Only reported by the first test of a browser session
+    timings['startup'] = browser.startup
+    browser.startup = None
+
+  start = time.monotonic()
+  driver.get(TEST_URL)
   wait = WebDriverWait(driver, 120)
   element = wait.until(EC.presence_of_element_located((By.ID, 'modal-confirm')))
+  timings['load'] = time.monotonic() - start
+
+  start = time.monotonic()
   element.click()
   wait.until(EC.presence_of_element_located((By.ID, 'testresult-detail')))
   WebDriverWait(driver, 10).until(EC.text_to_be_present_in_element((By.TAG_NAME, "td"), "Download"))
-except Exception as e: # pylint: disable=broad-exception-caught
-  # Catching all errors and terminate
-  log("Failed to run RTR-Netztest: " + str(e))
-  driver.quit()
-  sys.exit()
-
-if not os.path.exists(EVIDENCE_DIR):
-  os.makedirs(EVIDENCE_DIR)
-driver.save_screenshot(EVIDENCE_DIR + "/" + datetime.now().isoformat() + ".png")
-
-table = driver.find_element(By.ID, "testresult-detail")
-cells = table.find_elements(By.TAG_NAME, "td")
-results = {}
-for td in cells:
-  if td.get_attribute('data-label'):
-    key = td.get_attribute('data-label')
-    if key in numeric_fields:
-      value = float(td.text.split()[0].replace(",","."))
-    else:
-      value = td.text
-    results[key] = value
-
-for key in numeric_fields:
-  # Assembling PEF (Prometheus Exposition Format)
-  metric = key.lower()
-  value = results[key]
-
-  labels = 'job="rtr-netztest"'
-  labels += f',date="{datetime.now().date()}"'
-  labels += f',ip="{results["Externe IP"]}"'
-  labels += f',provider="{results["Betreiber"]}"'
-  if sys.stdout.isatty(): labels += ',mode="manual"'
-
-  pef = f'{metric}{{{labels}}} {value} {round(datetime.now().timestamp()*1000)}'
-  r = requests.post("http://localhost:8428/api/v1/import/prometheus", data=pef, timeout=5)
-  log("Sending Prometheus Exposition Format data to Victoriametrics: " + pef)
-  log("Victoriametrics API response: " + str(r.status_code))
-
-  # Quality timeseries
-
-  # Assign quality label based on thresholds
-  for k in t[metric]:
-    l = t[metric][k]
-    if l['lower'] <= value <= l['upper']:
-      quality = k
-      break
+  timings['test'] = time.monotonic() - start
 
-  timestamp = round(datetime.now().timestamp()*1000)
-  # For each quality level a seperate timeseries is created
-  # to allow to show all quality levels in e.g. pie charts
-  # even if the quality level does not exisit in the observed range.
-  for k in t[metric]:
-    value = 1 if k == quality else 0
+  start = time.monotonic()
+  # Kept in memory, stored after the results were pushed
+  screenshot = driver.get_screenshot_as_png()
+
+  # A single JSON request instead of walking the result table
+  results = fetch(WebDriverWait(driver, 10).until(test_uuid, "No test UUID in the result page URL"), control_server)
+  timings['scrape'] = time.monotonic() - start
+
+  return results, timings, screenshot
+
+def report(results, timings, thresholds, history):
+  """ Push results, quality and phase timings of a test as a single batch, 'history' is optional """
+  batch = []
+  for key in numeric_fields:
+    # Assembling PEF (Prometheus Exposition Format)
+    metric = key.lower()
+    value = results[key]
 
     labels = 'job="rtr-netztest"'
-    labels += f',metric="{metric}"'
-    labels += f',quality="{k}"'
     labels += f',date="{datetime.now().date()}"'
     labels += f',ip="{results["Externe IP"]}"'
     labels += f',provider="{results["Betreiber"]}"'
     if sys.stdout.isatty(): labels += ',mode="manual"'
 
-    pef = f'quality{{{labels}}} {value} {timestamp}'
-    r = requests.post("http://localhost:8428/api/v1/import/prometheus", data=pef, timeout=5)
-    log("Sending Prometheus Exposition Format data to Victoriametrics: " + pef)
-    log("Victoriametrics API response: " + str(r.status_code))
+    batch.append(f'{metric}{{{labels}}} {value} {round(datetime.now().timestamp()*1000)}')
+
+    # Quality timeseries
+
+    # Assign quality label based on thresholds
+    level = quality(thresholds[metric], value)
+
+    timestamp = round(datetime.now().timestamp()*1000)
+    # For each quality level a seperate timeseries is created
+    # to allow to show all quality levels in e.g. pie charts
+    # even if the quality level does not exisit in the observed range.
+    for k in thresholds[metric]:
+      value = 1 if k == level else 0
+
+      labels = 'job="rtr-netztest"'
+      labels += f',metric="{metric}"'
+      labels += f',quality="{k}"'
+      labels += f',date="{datetime.now().date()}"'
+      labels += f',ip="{results["Externe IP"]}"'
+      labels += f',provider="{results["Betreiber"]}"'
+      if sys.stdout.isatty(): labels += ',mode="manual"'
+
+      batch.append(f'quality{{{labels}}} {value} {timestamp}')
+
+  timestamp = round(datetime.now().timestamp()*1000)
+  for (phase, seconds) in timings.items():
+    batch.append(f'phase_seconds{{job="rtr-netztest",phase="{phase}"}} {seconds:.3f} {timestamp}')
+
+  push(batch)
+
+  if history:
+    values = {key.lower(): results[key] for key in numeric_fields}
+    history.append(results["Betreiber"], results["Externe IP"], values, thresholds)
+
+def test(browser, control_server, thresholds, history, evidence):
+  """ Run and report a single test, returns False if it failed """
+  log("Starting test run ...")
+  try:
+    results, timings, screenshot = run(browser, control_server)
+    report(results, timings, thresholds, history)
+    evidence.submit(screenshot, results)
+  except Exception as e: # pylint: disable=broad-exception-caught
+    # Catching all errors, the browser is restarted for the next test
+    log("Failed to run RTR-Netztest: " + str(e))
+    browser.stop()
+    push([])
+    return False
+
+  log("Finished test run ...")
+  return True
+
+def main(args):
+  """ Run a single test, or keep testing in daemon mode """
+  config = settings.load(args.config_file)
+  control_server = args.control_server or getattr(config, 'control_server', CONTROL_SERVER)
+  thresholds = config.thresholds
+  history = History(config.history['database']) if getattr(config, 'history', None) else None
+  evidence = Evidence(getattr(config, 'evidence', None))
+
+  browser = Browser()
+  if args.daemon:
+    while True:
+      try:
+        test(browser, control_server, thresholds, history, evidence)
+      except Exception as e: # pylint: disable=broad-exception-caught
+        # Cleaning up a failed test failed too, the daemon keeps scheduling tests
+        log("Failed to recover from RTR-Netztest failure: " + str(e))
+      time.sleep(max(args.interval + random.uniform(-args.jitter, args.jitter), 0))
+  else:
+    test(browser, control_server, thresholds, history, evidence)
+    browser.stop()
+    evidence.close()
 
-driver.quit()
-display.stop()
-syslog.syslog("Finished test run ...")
+if __name__ == "__main__":
+  main(cli.parse_args())
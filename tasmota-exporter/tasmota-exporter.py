@@ -3,35 +3,67 @@
 # Dependencies:
 #  apt install python3-prometheus-client
 #  apt install python3-requests
-#  apt install python3-uritools
 #  apt install python3-yaml
+#  prometheus_tools (shared exporter core, found next to this script's directory)
+#  apt install python3-paho-mqtt (optional, for --mqtt)
 
 """
 Prometheus exporter for metrics of Tasmota WiFi Socket A1T using
 the Tasmota API interface
 """
 
+import math
 import os
 import sys
-import traceback
+import threading
+import time
 import logging
 import logging.handlers
 import json
 
 import argparse
 from argparse import BooleanOptionalAction
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from functools import partial
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlsplit
 from icecream import ic
-import prometheus_client as prom
-from prometheus_client import Metric, CollectorRegistry, generate_latest
 import requests
-from uritools import urisplit
-import yaml
-from yaml.loader import SafeLoader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+# pylint: disable=wrong-import-position
+from prometheus_tools import breaker, cache, exposition, fanout, instrument, poller, recorder, ring, server, settings
+from prometheus_tools import transport
 
 PROGRAMNAME = os.path.basename(sys.argv[0])
 CONFIGFILE = os.path.splitext(PROGRAMNAME)[0] + '.conf'
 LISTEN = ':8000'
+FLEET_DEADLINE = 10
+MQTT_TOPIC = "tele/+/SENSOR"
+MQTT_TIMEOUT = 300
+SAMPLER_RATE = 1
+SAMPLER_WINDOW = 60
+SAMPLER_METRICS = ["Power", "Current", "ApparentPower"]
+SAMPLER_WORKERS = 16
+
+DEVICE_UP = exposition.family("device_up", "Tasmota device answered the status request", "gauge")
+PAYLOAD = exposition.family("status_payload_bytes", "Size of the Tasmota status response", "gauge")
+TELEMETRY_AGE = exposition.family("telemetry_age_seconds", "Seconds since the last MQTT telemetry message", "gauge")
+WINDOW_SAMPLES = exposition.family("sampler_window_samples", "Samples taken in the last finished window", "gauge")
+
+# Smallest status command returning each status section
+STATUS = {
+  "Status": "status",
+  "StatusPRM": "status 1",
+  "StatusFWR": "status 2",
+  "StatusLOG": "status 3",
+  "StatusMEM": "status 4",
+  "StatusNET": "status 5",
+  "StatusMQT": "status 6",
+  "StatusTIM": "status 7",
+  "StatusSNS": "status 8",
+  "StatusSTS": "status 11",
+}
+STATUS_ALL = "status 0"
 
 def formatter(prog): return argparse.HelpFormatter(prog, max_help_position=45)
 cli = argparse.ArgumentParser(
@@ -43,172 +75,432 @@ cli = argparse.ArgumentParser(
 cli.add_argument('-c', '--config', action='store', default=CONFIGFILE, help="config file location")
 cli.add_argument('-l', '--listen', action='store', default=LISTEN, help="server address and port")
 cli.add_argument('--self-metrics', action=BooleanOptionalAction, help="enable process metrics")
-args = cli.parse_args()
+cli.add_argument('-w', '--workers', action='store', type=int, default=server.WORKERS, help="concurrent scrapes")
+cli.add_argument('--poll', action=BooleanOptionalAction, help="poll devices in the background")
+cli.add_argument('--mqtt', action=BooleanOptionalAction, help="ingest MQTT telemetry, poll silent devices")
+cli.add_argument('--sampler', action=BooleanOptionalAction, help="sample power at a high rate between scrapes")
+cli.add_argument('--record', action='store', metavar='FILE', help="record device API responses to an archive")
+cli.add_argument('--replay', action='store', metavar='FILE', help="serve device API responses from an archive")
+cli.add_argument('--replay-speed', action='store', type=float, default=1, help="replay speed factor, 0 without delays")
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 loghandler = logging.handlers.SysLogHandler(address = '/dev/log')
 log.addHandler(loghandler)
 
-if not args.self_metrics:
-  prom.REGISTRY.unregister(prom.PROCESS_COLLECTOR)
-  prom.REGISTRY.unregister(prom.PLATFORM_COLLECTOR)
-  prom.REGISTRY.unregister(prom.GC_COLLECTOR)
+class Descriptor(NamedTuple):
+  """ Immutable descriptor of a configured metric, compiled once at config load """
+
+  metric: str
+  family: exposition.Family
+
+def describe(metric, metadata):
+  """ Return the descriptor of 'metric' configured with 'metadata' (description, metrictype) """
+  metadata = metadata or {}
+  description = metadata.get("description") or f"Tasmota WiFi socket A1T metric {metric}"
+  metrictype = metadata.get("metrictype") or "untyped"
+  return Descriptor(metric, exposition.family(metric, description, metrictype))
+
+class Telemetry():
+  """
+    Latest MQTT telemetry (tele/<topic>/SENSOR) of all devices
+    The SENSOR message carries the same ENERGY fields as the StatusSNS
+    section of a status request, so scrapes are answered from memory.
+  """
+
+  def __init__(self, config, targets):
+    config = config or {}
+    self.config = config
+    self.timeout = config.get('timeout', MQTT_TIMEOUT)
+    pattern = config.get('topic', MQTT_TOPIC)
+    self.pattern = pattern.split("/")
+    # Device topics are configured per target
+    self.topics = {c['topic']: target for (target, c) in targets.items() if c.get('topic')}
+    self.lock = threading.Lock()
+    self.latest = {}
+
+  def start(self):
+    """ Connect to the broker and subscribe in a background thread """
+    # Optional dependency, only required in MQTT mode
+    import paho.mqtt.client as mqtt # pylint: disable=import-outside-toplevel
+
+    try:
+      client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    except AttributeError:
+      # paho-mqtt < 2.0
+      client = mqtt.Client()
+    if self.config.get('username'):
+      client.username_pw_set(self.config['username'], self.config.get('password'))
+    client.on_connect = self.on_connect
+    client.on_message = self.on_message
+    client.connect_async(self.config.get('host', 'localhost'), self.config.get('port', 1883))
+    client.loop_start()
+    return client
+
+  def on_connect(self, client, *_):
+    """ (Re-)subscribe on every connect """
+    client.subscribe("/".join(self.pattern))
+
+  def on_message(self, client, userdata, message): # pylint: disable=unused-argument
+    """ paho-mqtt message callback """
+    self.ingest(message.topic, message.payload)
+
+  def ingest(self, topic, payload):
+    """ Store the telemetry 'payload' published on 'topic' """
+    levels = topic.split("/")
+    if len(levels) != len(self.pattern) or "+" not in self.pattern:
+      return
+    target = self.topics.get(levels[self.pattern.index("+")])
+    if target is None:
+      return
+
+    try:
+      data = json.loads(payload)
+    except ValueError:
+      return
+    # Valid JSON may still be no SENSOR message, e.g. a number or null
+    if not isinstance(data, dict) or not isinstance(data.get("ENERGY"), dict):
+      return
+
+    with self.lock:
+      self.latest[target] = (time.time(), data)
+
+  def status(self, target, modules):
+    """
+      Returning (status, age) from telemetry covering all 'modules' or None,
+      if a module is not covered or the device has gone silent
+    """
+    if any(module != "StatusSNS" for module in modules):
+      return None
+    with self.lock:
+      entry = self.latest.get(target)
+    if entry is None:
+      return None
+    age = time.time() - entry[0]
+    if age > self.timeout:
+      return None
+
+    return {"StatusSNS": entry[1]}, age
+
+class Sampler():
+  """
+    High-frequency sampling of selected ENERGY fields between scrapes
+    Samples are collected in windows of fixed length aligned to the clock, each
+    device keeps a fixed-size ring buffer per metric. Scrapes expose min/max/mean/last
+    of the last finished window, so every scraper sees the same statistics.
+  """
+
+  def __init__(self, tasmota, config):
+    config = config or {}
+    self.tasmota = tasmota
+    rate = config.get('rate', SAMPLER_RATE)
+    self.interval = 1 / rate
+    self.length = config.get('window', SAMPLER_WINDOW)
+    self.metrics = config.get('metrics') or SAMPLER_METRICS
+    self.families = {}
+    for metric in self.metrics:
+      for stat in ("min", "max", "mean", "last"):
+        self.families[(metric, stat)] = exposition.family(f"{metric}_{stat}",
+          f"Tasmota {metric} {stat} of the samples in the last finished window", "gauge")
+    self.lock = threading.Lock()
+    size = math.ceil(self.length * rate) + 1
+    self.rings = {target: {metric: ring.Ring(size) for metric in self.metrics} for target in tasmota.credentials}
+    # Per target: (window, samples written before it) of the window being filled
+    self.current = dict.fromkeys(tasmota.credentials, (None, 0))
+    # Per target: (window, samples, statistics per metric) of the last finished window
+    self.finished = dict.fromkeys(tasmota.credentials, (None, 0, {}))
+    self.running = set()
+    # Sampling has its own pool, so fleet probes never queue behind samples
+    self.pool = fanout.executor(config.get('workers', SAMPLER_WORKERS), name="sampler")
+
+  def window(self, timestamp):
+    """ Return the number of the window 'timestamp' falls into """
+    return int(timestamp // self.length)
+
+  def start(self):
+    """ Start sampling all devices in a background thread """
+    threading.Thread(target=self.schedule, name="sampler", daemon=True).start()
+
+  def schedule(self):
+    """ Sample every device once per interval, skipping devices still busy """
+    due = time.monotonic()
+    while True:
+      for target in self.rings:
+        with self.lock:
+          if target in self.running:
+            continue
+          self.running.add(target)
+        self.pool.submit(self.sample, target)
+      due += self.interval
+      time.sleep(max(due - time.monotonic(), 0))
+
+  def sample(self, target):
+    """ Take one sample of 'target' """
+    try:
+      r = self.tasmota.query(target, STATUS["StatusSNS"])
+      if r is None:
+        return
+      data = instrument.decode(STATUS["StatusSNS"], r.content)["StatusSNS"]["ENERGY"]
+      # All values are extracted first, the rings of a device always hold the same number of samples
+      values = {metric: data[metric] or 0 for metric in self.metrics}
+      window = self.window(time.time())
+      with self.lock:
+        self.finish(target, window)
+        for (metric, buffer) in self.rings[target].items():
+          buffer.append(values[metric])
+    except (ValueError, KeyError, TypeError) as e:
+      log.error("Sampling %s failed: %s", target, e)
+    finally:
+      with self.lock:
+        self.running.discard(target)
+
+  def finish(self, target, window):
+    """ Close the window being filled of 'target' if it ended before 'window', the caller holds the lock """
+    (current, since) = self.current[target]
+    if current == window:
+      return
+    rings = self.rings[target]
+    written = next(iter(rings.values())).written if rings else 0
+    if current is not None:
+      stats = {metric: buffer.window(since) for (metric, buffer) in rings.items()}
+      self.finished[target] = (current, written - since, stats)
+    self.current[target] = (window, written)
+
+  def expose(self, out, target):
+    """ Add the statistics of the last finished window of 'target' to exposition 'out' """
+    if target not in self.rings:
+      return
+    previous = self.window(time.time()) - 1
+    with self.lock:
+      # A window also ends without a sample taken after it, e.g. when the device went offline
+      if self.current[target][0] == previous:
+        self.finish(target, previous + 1)
+      (window, samples, stats) = self.finished[target]
+      # Windows without samples expose nothing instead of stale statistics
+      if window != previous:
+        samples, stats = 0, {}
+
+      out.add(WINDOW_SAMPLES, samples)
+      for (metric, values) in stats.items():
+        if values is None:
+          continue
+        for (stat, value) in zip(("min", "max", "mean", "last"), values):
+          out.add(self.families[(metric, stat)], value)
 
 class Tasmota():
 
   def __init__(self, config):
     self.config = config
+    self.breakers = breaker.Breakers(getattr(config, 'breaker', None))
+    self.fleetconfig = getattr(config, 'fleet', None) or {}
+    self.pool = fanout.executor(self.fleetconfig.get('workers', fanout.WORKERS), name="fleet")
+    self.telemetry = None
+    self.recorder = recorder.Recorder()
+    self.sampler = None
+
+    # Module configs and credentials are compiled once, scrapes do not touch the config anymore
+    self.modules = {}
+    self.commands = {}
+    for (module, moduleconfig) in config.modules.items():
+      metrics = (moduleconfig or {}).get("metrics") or {}
+      self.modules[module] = tuple(describe(metric, metadata) for (metric, metadata) in metrics.items())
+      self.commands[module] = (moduleconfig or {}).get("command") or STATUS.get(module, STATUS_ALL)
+    self.credentials = {}
+    for (target, targetconfig) in config.targets.items():
+      self.credentials[target] = f"user={targetconfig['username']}&password={targetconfig['password']}"
+
+    # Unknown group members would only fail at scrape time, reported as devices being down
+    for (group, members) in (self.fleetconfig.get('groups') or {}).items():
+      unknown = [member for member in members or [] if member not in self.credentials]
+      if unknown:
+        raise ValueError(f"Fleet group {group} has members not configured in 'targets': {', '.join(str(member) for member in unknown)}")
 
   def request(self, ip, endpoint):
     url = 'http://' + ip + endpoint
-    return requests.get(url, timeout=10)
+    # Requests are accounted by command, the endpoint carries the credentials
+    command = parse_qs(urlsplit(endpoint).query).get('cmnd', [endpoint])[0]
+    send = partial(instrument.request, command, transport.get, url, timeout=10)
+    return self.recorder.request(ip, endpoint, send)
 
-  def register(self, metrics, self_metrics=False):
-    """ Register a new Prometheus client registry """
-    class Collector():
-      """ Prometheus Client Collector class """
-      def collect(self):
-        """ Prometheus Client collect() function """
-        return metrics.values()
-
-    registry = CollectorRegistry()
-    registry.register(Collector())
+  def command(self, modules):
+    """
+      Returning the smallest status command covering all 'modules'
+      Several sections are fetched with 'status 0' in one request, as the
+      HTTP response of a 'Backlog' only contains the first command's result.
+    """
+    commands = {self.commands[module] for module in modules}
+    if len(commands) == 1:
+      return commands.pop()
 
-    if self_metrics:
-      registry.register(prom.PROCESS_COLLECTOR)
-      registry.register(prom.PLATFORM_COLLECTOR)
-      registry.register(prom.GC_COLLECTOR)
+    return STATUS_ALL
 
-    return registry
+  def getSensorData(self, target, modules):
+    """
+      Returning the exposition of metrics for Tasmota Wifi Socket A1T
+      All 'modules' are fetched in a single status request
+      API endpoint: /cm&cmnd=status+<section>
+    """
+    return self.sample(target, modules)
 
-  def getSensorData(self, target, module):
+  def sample(self, target, modules, labels=None):
     """
-      Returning metrics for Tasmota Wifi Socket A1T
-      API endpoint: /cm&cmnd=status+0
+      Returning the exposition of all 'modules' of 'target' with additional 'labels'
+      In MQTT mode fresh telemetry is used, silent devices are queried via HTTP
     """
-    metrics = {}
-    #labels = {}
-
-    result = b""
-    username = self.config.targets[target]["username"]
-    password = self.config.targets[target]["password"]
-    r = self.request(target, f"/cm?user={username}&password={password}&cmnd=status+0")
-    r = json.loads(r.text)
-    r = {k: v or 0 for (k, v) in r.items()}
-
-    ic(r)
-    r["__data"] = r[module]["ENERGY"]
-    for (metric, metricMetaData) in self.config.modules[module]["metrics"].items():
-      description = f"Tasmota WiFi socket A1T metric {metric}"
-      metrictype = "untyped"
-      unit = ""
-      unitsymbol = ""
-      if metricMetaData:
-         if "description" in metricMetaData:
-           description = metricMetaData["description"]
-         if "metrictype" in metricMetaData:
-           metrictype = metricMetaData["metrictype"]
-         if "unit" in metricMetaData:
-           unit = metricMetaData["unit"]
-         if "unitsymbol" in metricMetaData:
-           unitsymbol = metricMetaData["unitsymbol"]
-      metrics[metric] = Metric(metric, description, metrictype, f"{unit}_{unitsymbol}")
-      if not r["__data"][metric]: r["__data"][metric] = 0
-      metrics[metric].add_sample(metric, value=r["__data"][metric], labels="")
-
-    registry = self.register(metrics)
-    result = generate_latest(registry)
-
-    return result
-
-class Config():
-
-  def __init__(self, configfile):
-    config = {}
+    out = exposition.Exposition(labels)
 
-    try:
-      f = open(configfile, encoding="utf-8")
-    except OSError:
-      ic("Could not open/read file: " + configfile)
-      traceback.format_exc().strip()
-      sys.exit()
+    status, age = (self.telemetry.status(target, modules) if self.telemetry else None) or (None, None)
+    # Telemetry lacking a configured field is not used, the device is queried via HTTP instead
+    if status is not None and self.covers(status, modules):
+      out.add(DEVICE_UP, 1)
+      out.add(TELEMETRY_AGE, age)
+    else:
+      status = self.status(target, modules, out)
+      if status is None:
+        return out
+
+    for module in modules:
+      data = status[module]["ENERGY"]
+      for descriptor in self.modules[module]:
+        out.add(descriptor.family, data[descriptor.metric] or 0)
 
-    with f:
-      config = yaml.load(f, Loader=SafeLoader)
-      self._config = config
+    if self.sampler:
+      self.sampler.expose(out, target)
 
+    return out
 
-  def __getattr__(self, key):
+  def covers(self, status, modules):
+    """ Returning True if the status sections 'status' carry all configured metrics of 'modules' """
+    return all(descriptor.metric in status[module]["ENERGY"] for module in modules for descriptor in self.modules[module])
+
+  def query(self, target, command):
+    """ Sending status 'command' to 'target', returns the response or None if the device is down """
     try:
-      return self._config[key]
-    except KeyError as e:
+      # Unplugged sockets are skipped by their circuit breaker
+      endpoint = f"/cm?{self.credentials[target]}&cmnd={command.replace(' ', '+')}"
+      return self.breakers[target].call(self.request, target, endpoint)
+    except breaker.CircuitOpen:
+      return None
+    except requests.exceptions.RequestException as e:
+      ic.configureOutput(prefix="EXCEPTION| ")
       ic(e)
-      raise AttributeError(key) from e
+      ic.configureOutput(prefix="")
+      return None
 
-class Handler(BaseHTTPRequestHandler):
-  """ HTTP server request handler class """
+  def status(self, target, modules, out):
+    """ Returning the status sections of all 'modules' queried via HTTP or None if the device is down """
+    command = self.command(modules)
+    r = self.query(target, command)
+
+    out.add(DEVICE_UP, int(r is not None))
+    self.breakers.expose(out, [target])
+    if r is None:
+      return None
 
-  config = Config(args.config)
-  sensor = Tasmota(config)
-
-  # pylint: disable=invalid-name; Method provided by upstream class
-  def do_GET(self):
-    """ Provide data in Prometheus Exposition Format upon client request """
-    url = urisplit(self.path)
-
-    self.error_message_format = """
-      <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
-        "http://www.w3.org/TR/html4/strict.dtd">
-      <html>
-        <head>
-          <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
-          <title>Error response</title>
-        </head>
-        <body>
-          <h1>Error response</h1>
-          <p>Error code: %(code)d</p>
-          <p>Traceback: <pre>%(message)s</pre></p>
-          <p>Error code explanation: %(code)s - %(explain)s.</p>
-        </body>
-      </html>
+    out.add(PAYLOAD, len(r.content), {'command': command})
+
+    # Decoding the raw body skips the charset detection of response.text
+    return instrument.decode(command, r.content)
+
+  def fleet(self, targets, modules):
+    """
+      Returning the merged exposition of all 'targets' labeled by 'target'
+      Devices are queried concurrently on a bounded pool within one deadline
     """
+    deadline = self.fleetconfig.get('deadline', FLEET_DEADLINE)
+    calls = {target: partial(self.sample, target, modules, {'target': target}) for target in targets}
+    results, failures = fanout.gather(self.pool, calls, deadline)
+
+    out = exposition.Exposition()
+    for target in targets:
+      if target in results:
+        out.merge(results[target])
+    for (target, e) in failures.items():
+      if not isinstance(e, TimeoutError):
+        log.error("Fleet probe of %s failed: %s", target, e)
+      out.add(DEVICE_UP, 0, {'target': target})
+
+    return out.render()
+
+class Handler(server.ExporterHandler):
+  """ HTTP server request handler class """
 
-    # Avoid errors from browsers auto-requesting favicons
-    if self.path == '/favicon.ico':
-      self.send_response(200)
-      self.send_header('Content-Type', 'image/x-icon')
-      self.send_header('Content-Length', 0)
-      self.end_headers()
-      return
+  config = None
+  sensor = None
+  results = None
+  poller = None
+  routes = {**server.ExporterHandler.routes, '/probe_all': 'probe_all'}
 
-    query_params = url.getquerydict()
-    if "target" in query_params:
-      target = url.getquerydict().get('target')[0]
-    else:
-      self.send_error(404, message="No target!", explain="No target specified in query ...")
-      return
+  @classmethod
+  def modules(cls):
+    """ Return the configured modules, all are scraped by a status request """
+    return list(cls.sensor.modules)
 
-    if target not in self.config.targets:
-      self.send_error(404, message="Target does not exist!", explain=f"Target {target} not configured ...")
-      return
+  @classmethod
+  def scraper(cls, target, module):
+    """ Return the function scraping 'module' of 'target' """
+    if module not in cls.sensor.modules:
+      raise server.HTTPError(404, message="No such module!", explain=f"Cannot find module {module}.")
 
-    # Prometheus is quering multiple modules in one request -> multiple 'module' params possible
-    modules = url.getquerydict().get('module')
-    if modules is None:
-      self.send_error(404, message="No module!", explain="No target specified in query ...")
-      return
+    return partial(cls.sensor.getSensorData, target, [module])
 
-    metrics = b""
-    for module in modules:
-      metrics = b"".join([metrics, self.sensor.getSensorData(target, module)])
+  def collect(self, target, modules):
+    """ Provide data in Prometheus Exposition Format for all requested modules """
+    if self.poller:
+      return self.poller.collect(target, modules)
 
-    self.send_response(200)
-    self.end_headers()
-    self.wfile.write(metrics)
+    for module in modules:
+      if module not in self.sensor.modules:
+        raise server.HTTPError(404, message="No such module!", explain=f"Cannot find module {module}.")
+
+    # All modules of a scrape share a single status request to the device
+    scrape = partial(self.sensor.getSensorData, target, modules)
+    out = exposition.Exposition()
+    out.merge(self.results.get(target, "+".join(modules), scrape))
+    self.results.expose(out, target)
+    return out.render()
+
+  def probe_all(self, query_params):
+    """ Answer a fleet probe '/probe_all?module=<module>[&group=<group>]' of many targets at once """
+    modules = query_params.get('module')
+    if modules is None:
+      raise server.HTTPError(404, message="No module!", explain="No module specified in query ...")
+    for module in modules:
+      if module not in self.sensor.modules:
+        raise server.HTTPError(404, message="No such module!", explain=f"Cannot find module {module}.")
+
+    targets = list(self.targets)
+    if "group" in query_params:
+      group = query_params['group'][0]
+      groups = self.sensor.fleetconfig.get('groups') or {}
+      if group not in groups:
+        raise server.HTTPError(404, message="Group does not exist!", explain=f"Group {group} not configured ...")
+      targets = groups[group]
+
+    return self.sensor.fleet(targets, modules)
+
+def plugin(options, config):
+  """ Set up the exporter with 'config' and the command line 'options', returns its handler """
+  Handler.config = config
+  Handler.sensor = Tasmota(config)
+  Handler.targets = config.targets
+  Handler.results = cache.Cache(getattr(config, 'cache', None))
+  Handler.sensor.recorder = recorder.Recorder(options.record, options.replay, options.replay_speed)
+  if options.mqtt:
+    Handler.sensor.telemetry = Telemetry(getattr(config, 'mqtt', None), Handler.targets)
+    Handler.sensor.telemetry.start()
+  if options.sampler:
+    Handler.sensor.sampler = Sampler(Handler.sensor, getattr(config, 'sampler', None))
+    Handler.sensor.sampler.start()
+  if options.poll:
+    jobs = poller.jobs(Handler.targets, Handler.sensor.modules, Handler.scraper)
+    Handler.poller = poller.Poller(jobs, getattr(config, 'poll', None))
+    Handler.poller.start()
+  return Handler
 
 if __name__ == '__main__':
-  address, port = args.listen.split(":")
-  print(f"Starting {PROGRAMNAME} on {address}:{port} ...")
-  server = HTTPServer((address, int(port)), Handler)
-  server.serve_forever()
+  args = cli.parse_args()
+  server.self_metrics(args.self_metrics)
+  handler = plugin(args, settings.load(args.config))
+  print(f"Starting {PROGRAMNAME} on {args.listen} ...")
+  server.serve(args.listen, handler, args.workers)